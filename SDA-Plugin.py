@@ -8,15 +8,27 @@ import hashlib
 import time
 import logging
 import re
+import string
 import unicodedata
 import threading
 import io
 import shutil
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty, Full
+from bisect import bisect_left, insort
+from collections import deque
+from collections.abc import Mapping
+from types import MappingProxyType
 from html import escape, unescape
 from datetime import datetime
 from telebot.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from telebot.apihelper import ApiTelegramException
 from FunPayAPI.updater.events import NewMessageEvent
+try:
+    import sqlite3
+except Exception:
+    sqlite3 = None
 if TYPE_CHECKING:
     from cardinal import Cardinal
 NAME = 'Steam Guard (SDA)'
@@ -26,6 +38,26 @@ CREDITS = '@tinechelovec'
 UUID = 'b886288e-7908-4f62-bd48-48e1a5c7a8e5'
 SETTINGS_PAGE = True
 logger = logging.getLogger('SteamGuardSDA')
+
+def _env_int(name: str, default: int, lo: Optional[int]=None, hi: Optional[int]=None) -> int:
+    try:
+        value = int(str(os.getenv(name, default)).strip())
+    except (TypeError, ValueError):
+        logger.warning(f'{PREFIX} invalid {name}, using {default}')
+        value = default
+    if lo is not None:
+        value = max(lo, value)
+    if hi is not None:
+        value = min(hi, value)
+    return value
+
+def _env_float(name: str, default: float, lo: Optional[float]=None) -> float:
+    try:
+        value = float(str(os.getenv(name, default)).strip())
+    except (TypeError, ValueError):
+        logger.warning(f'{PREFIX} invalid {name}, using {default}')
+        value = default
+    return value if lo is None else max(lo, value)
 PREFIX = '[SteamGuardSDA]'
 INSTRUCTION_URL = f'https://teletype.in/@tinechelovec/Steam-Guard-SDA'
 CREATOR_URL = 'https://t.me/tinechelovec'
@@ -35,12 +67,19 @@ SDA_GITHUB_URL = os.getenv('SDA_PLUGIN_GITHUB_URL', 'https://github.com/tinechel
 SDA_UPDATE_URL = os.getenv('SDA_PLUGIN_UPDATE_URL', 'https://raw.githubusercontent.com/tinechelovec/FPC-Plugin-Steam-Guard-SDA/main/SDA-Plugin.py').strip()
 PLUGIN_FOLDER = 'storage/plugins/steam_guard_sda'
 DATA_FILE = os.path.join(PLUGIN_FOLDER, 'data.json')
+DATA_SCHEMA_VERSION = 1
 USAGE_FILE = os.path.join(PLUGIN_FOLDER, 'usage.json')
+USAGE_DB_FILE = os.path.join(PLUGIN_FOLDER, 'usage.sqlite3')
+USAGE_BACKEND = os.getenv('SDA_USAGE_BACKEND', 'sqlite').strip().lower()
+USAGE_SWEEP_INTERVAL = _env_int('SDA_USAGE_SWEEP_INTERVAL_SEC', 900, 60)
 LOGS_FILE = os.path.join(PLUGIN_FOLDER, 'logs.json')
+LOGS_DIR = os.path.join(PLUGIN_FOLDER, 'logs')
 QUEUE_FILE = os.path.join(PLUGIN_FOLDER, 'queue.json')
 NOTIFY_DEBUG_FILE = os.path.join(PLUGIN_FOLDER, 'notify_debug.log')
+OUTBOX_FILE = os.path.join(PLUGIN_FOLDER, 'outbox.json')
 os.makedirs(PLUGIN_FOLDER, exist_ok=True)
-for fpath, default in [(DATA_FILE, {}), (USAGE_FILE, {}), (LOGS_FILE, {}), (QUEUE_FILE, {})]:
+os.makedirs(LOGS_DIR, exist_ok=True)
+for fpath, default in [(DATA_FILE, {}), (USAGE_FILE, {}), (QUEUE_FILE, {})]:
     if not os.path.exists(fpath):
         with open(fpath, 'w', encoding='utf-8') as f:
             json.dump(default, f, indent=4, ensure_ascii=False)
@@ -95,6 +134,7 @@ CB_ACCOUNT_TEXT_GLOBAL = f'{UUID}:eg'
 CB_ACCOUNT_TEXT_CUSTOM = f'{UUID}:ex'
 CB_ACCOUNT_EDIT_SECRET = f'{UUID}:es'
 CB_ACCOUNT_EDIT_LIMIT = f'{UUID}:el'
+CB_ACCOUNT_EDIT_SLOTS = f'{UUID}:ew'
 CB_ACCOUNT_TOGGLE_ENABLED = f'{UUID}:ae'
 CB_ACCOUNT_TOGGLE_QUEUE = f'{UUID}:aq'
 CB_ACCOUNT_TOGGLE_NOTIFY = f'{UUID}:an'
@@ -117,19 +157,139 @@ CB_DELETE_PLUGIN_YES = f'{UUID}:del_plugin_yes'
 CB_DELETE_PLUGIN_NO = f'{UUID}:del_plugin_no'
 _fsm: Dict[int, Dict[str, Any]] = {}
 _INVIS_RE = re.compile('[\\u200B-\\u200F\\u202A-\\u202E\\u2060-\\u206F\\uFE0E\\uFE0F\\u00AD]')
+_ASCII_CMD_DROP = str.maketrans('', '', ''.join(map(chr, range(33))) + '\x7f')
+class _LockStripes:
+    __slots__ = ('_locks',)
+
+    def __init__(self, size: int):
+        self._locks = tuple((threading.RLock() for _ in range(max(1, size))))
+
+    def __call__(self, key) -> threading.RLock:
+        return self._locks[hash(key) % len(self._locks)]
+
+    def __enter__(self):
+        for lock in self._locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        for lock in reversed(self._locks):
+            lock.release()
+        return False
+
+class _UnitOfWork:
+    __slots__ = ('depth', 'queue', 'sends')
+
+    def __init__(self):
+        self.depth = 0
+        self.queue = False
+        self.sends: List[tuple] = []
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if not self.depth:
+            self.commit()
+        return False
+
+    def commit(self):
+        queue, sends = (self.queue, self.sends)
+        self.queue = False
+        self.sends = []
+        if queue:
+            _flush_queue()
+        for lane, rec in sends:
+            lane.put(rec)
+_uow_local = threading.local()
+LOCK_STRIPES = _env_int('SDA_LOCK_STRIPES', 64, 1)
 _usage_lock = threading.RLock()
+_usage_stripes = _LockStripes(LOCK_STRIPES)
+_usage_local = threading.local()
+_usage_db_ready = False
+_usage_db_failed = False
+_usage_sweeper_started = False
 _queue_lock = threading.RLock()
+_queue_stripes = _LockStripes(LOCK_STRIPES)
+_queue_rows: Dict[str, dict] = {}
+_queue_state: Optional[Dict[str, dict]] = None
+_queue_dirty: set = set()
+_QUEUE_ITEM_FIELDS = ('buyer_id', 'chat_id', 'command', 'account_id', 'enqueued_at', 'owner_uid')
 _timer_lock = threading.RLock()
-_queue_timers: Dict[str, threading.Timer] = {}
+_queue_timers: Dict[str, int] = {}
+_timer_heap: List[tuple] = []
+_timer_seq = 0
+_queue_tick_thread: Optional[threading.Thread] = None
+_queue_tick_cardinal = None
+_queue_executor: Optional[ThreadPoolExecutor] = None
+QUEUE_WORKERS = _env_int('SDA_QUEUE_WORKERS', 4, 1)
+QUEUE_TICK_LAG = 0.05
+ACCOUNT_MAX_SLOTS = 10
+CODE_MIN_VALIDITY = _env_int('SDA_CODE_MIN_VALIDITY_SEC', 5, 0, 25)
+STEAM_TIME_SYNC = os.getenv('SDA_STEAM_TIME_SYNC', '0').strip().lower() in {'1', 'true', 'yes', 'on'}
+STEAM_TIME_URL = os.getenv('SDA_STEAM_TIME_URL', 'https://api.steampowered.com/ITwoFactorService/QueryTime/v0001').strip() if STEAM_TIME_SYNC else ''
+STEAM_TIME_SYNC_INTERVAL = _env_int('SDA_STEAM_TIME_SYNC_SEC', 1800, 60)
+STEAM_TIME_RETRY_INTERVAL = 60
+_steam_clock_lock = threading.Lock()
+_steam_clock: Dict[str, Any] = {'offset': 0, 'synced_at': 0.0, 'drift': 0.0, 'error': '', 'started': False}
+OUTBOX_WORKERS = _env_int('SDA_OUTBOX_WORKERS', 3, 1)
+OUTBOX_QUEUE_SIZE = 1000
+OUTBOX_MAX_ATTEMPTS = _env_int('SDA_OUTBOX_MAX_ATTEMPTS', 5, 1)
+OUTBOX_RETRY_BASE = 2.0
+OUTBOX_RETRY_CAP = 30.0
+_outbox_lock = threading.RLock()
+_outbox_cond = threading.Condition(_outbox_lock)
+_outbox_lanes: List[Queue] = []
+_outbox_records: Optional[Dict[str, dict]] = None
+_outbox_seq = 0
+_outbox_inflight: set = set()
+_outbox_latest_notice: Dict[str, str] = {}
+_outbox_dirty: set = set()
+SEND_RATE = _env_float('SDA_SEND_RATE', 3.0, 0.1)
+SEND_BURST = _env_int('SDA_SEND_BURST', 6, 1)
+SEND_PRIORITY_CODE = 0
+SEND_PRIORITY_REPLY = 1
+SEND_PRIORITY_INFO = 2
+_send_bucket_cond = threading.Condition()
+_send_bucket: Dict[str, Any] = {'tokens': float(SEND_BURST), 'at': time.monotonic(), 'waiting': [0, 0, 0]}
+_send_stats: Dict[str, int] = {'sent': 0, 'delayed': 0, 'dropped': 0, 'coalesced': 0}
+_outbox_cardinal = None
+_outbox_retry_started = False
 _suppress_own_notification_until = 0.0
 _suppress_own_notification_lock = threading.RLock()
 _recent_command_suppressions: List[dict] = []
 _notify_debug_lock = threading.RLock()
+NOTIFY_DEBUG_QUEUE_SIZE = 5000
+NOTIFY_DEBUG_BATCH_SIZE = 500
+NOTIFY_DEBUG_FLUSH_INTERVAL = 1.0
+NOTIFY_DEBUG_SEGMENT_SIZE = 700000
+NOTIFY_DEBUG_SEGMENTS = 3
+_notify_debug_queue: Queue = Queue(maxsize=NOTIFY_DEBUG_QUEUE_SIZE)
+_notify_debug_writer_started = False
+_notify_debug_dropped = 0
 _logger_filter_lock = threading.RLock()
 _original_logger_log = None
+CONSOLE_FILTER_LOGGERS = tuple((x.strip() for x in os.getenv('SDA_CONSOLE_FILTER_LOGGERS', 'FPC,TGBot').split(',') if x.strip()))
+CONSOLE_FILTER_MAX_LEVEL = logging.INFO
+_CONSOLE_HINT_RE = re.compile('новое сообщение|новые сообщения|new messages?|переписк|cid:|┌──|└──|команд|command', re.I)
+_console_logger_scope: Dict[str, bool] = {}
+_filter_guard = threading.local()
 _logs_lock = threading.RLock()
+_log_index: Dict[str, Dict[str, Any]] = {}
+_log_pending: deque = deque()
+STORE_FLUSH_INTERVAL = 1.0
+_store_flusher_started = False
+_logs_migrated = False
 _ui_audit_lock = threading.RLock()
 _recent_ui_callback_ids: Dict[str, float] = {}
+DATA_STAT_INTERVAL = 1.0
+_data_cache_lock = threading.RLock()
+_data_cache: Dict[str, Any] = {'view': None, 'stamp': None, 'checked_at': 0.0, 'loading': False, 'derived': {}}
+_template_cache: Dict[str, Optional[tuple]] = {}
+TEMPLATE_CACHE_SIZE = 256
+_EMPTY_VIEW = MappingProxyType({})
 
 def _unwrap_callable_chain(func, max_depth: int=80):
     chain = []
@@ -185,18 +345,129 @@ def _load_json(path: str) -> dict:
         logger.error(f'{PREFIX} _load_json({path}) error: {e}')
         return {}
 
-def _save_json(path: str, data: dict):
+def _save_json(path: str, data: dict) -> bool:
     try:
-        with open(path, 'w', encoding='utf-8') as f:
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=4, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        return True
     except Exception as e:
         logger.error(f'{PREFIX} _save_json({path}) error: {e}')
+        return False
+
+def _freeze(value):
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple((_freeze(v) for v in value))
+    return value
+
+def _thaw(value):
+    if isinstance(value, Mapping):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+def _file_stamp(path: str) -> Optional[tuple]:
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+def _store_data_snapshot(data, stamp):
+    _data_cache['view'] = _freeze(data if isinstance(data, Mapping) else {})
+    _data_cache['stamp'] = stamp
+    _data_cache['checked_at'] = time.monotonic()
+    _data_cache['derived'] = {}
+    _prune_totp_cache(_data_cache['view'])
+
+def _data_schema_version(data: Mapping) -> int:
+    cfg = data.get('global')
+    try:
+        return int(cfg.get('schema_version') or 0) if isinstance(cfg, Mapping) else 0
+    except (TypeError, ValueError):
+        return 0
+
+def _migrate_data(data: dict) -> bool:
+    if _data_schema_version(data) >= DATA_SCHEMA_VERSION:
+        return False
+    for owner_uid, accounts in data.items():
+        if owner_uid != 'global' and isinstance(accounts, list):
+            _ensure_account_ids(str(owner_uid), accounts)
+    if not isinstance(data.get('global'), dict):
+        data['global'] = _default_cfg()
+    data['global']['schema_version'] = DATA_SCHEMA_VERSION
+    return True
+
+def _migrate_data_file():
+    if not os.path.exists(DATA_FILE):
+        return
+    data = _load_json(DATA_FILE)
+    if isinstance(data, dict) and _migrate_data(data):
+        save_data(data)
+        logger.info(f'{PREFIX} data.json migrated to schema {DATA_SCHEMA_VERSION}')
+
+def _load_data_snapshot():
+    stamp = _file_stamp(DATA_FILE)
+    data = _load_json(DATA_FILE)
+    if not isinstance(data, dict):
+        data = {}
+    changed = _migrate_data(data)
+    _store_data_snapshot(data, stamp)
+    if changed and _save_json(DATA_FILE, data):
+        _data_cache['stamp'] = _file_stamp(DATA_FILE)
+
+def _data_view() -> Mapping:
+    with _data_cache_lock:
+        view = _data_cache['view']
+        if _data_cache['loading']:
+            return view if view is not None else _EMPTY_VIEW
+        now = time.monotonic()
+        if view is not None and now - _data_cache['checked_at'] < DATA_STAT_INTERVAL:
+            return view
+        _data_cache['checked_at'] = now
+        if view is not None and _file_stamp(DATA_FILE) == _data_cache['stamp']:
+            return view
+        _data_cache['loading'] = True
+        try:
+            _load_data_snapshot()
+        finally:
+            _data_cache['loading'] = False
+        return _data_cache['view']
+
+def _snapshot_derived(name: str, builder, data: Optional[Mapping]=None):
+    with _data_cache_lock:
+        view = _data_view()
+        if data is not None and data is not view:
+            return builder(data)
+        derived = _data_cache['derived']
+        if name not in derived:
+            derived[name] = builder(view)
+        return derived[name]
+
+def _iter_owner_accounts(data: Optional[Mapping]=None):
+    if data is None:
+        data = _data_view()
+    for owner_uid, accounts in (data or {}).items():
+        if owner_uid == 'global' or not isinstance(accounts, (list, tuple)):
+            continue
+        yield (str(owner_uid), accounts)
 
 def load_data() -> dict:
-    return _load_json(DATA_FILE)
+    return _thaw(_data_view())
 
 def save_data(data: dict):
-    _save_json(DATA_FILE, data)
+    _migrate_data(data)
+    with _data_cache_lock:
+        view = _data_cache['view']
+        if view is not None and _file_stamp(DATA_FILE) == _data_cache['stamp'] and _thaw(view) == data:
+            return
+        if _save_json(DATA_FILE, data):
+            _store_data_snapshot(data, _file_stamp(DATA_FILE))
+        else:
+            _data_cache['view'] = None
 
 def load_usage() -> dict:
     return _load_json(USAGE_FILE)
@@ -204,52 +475,567 @@ def load_usage() -> dict:
 def save_usage(data: dict):
     _save_json(USAGE_FILE, data)
 
-def load_logs() -> dict:
-    return _load_json(LOGS_FILE)
+def _usage_db():
+    global _usage_db_ready, _usage_db_failed
+    conn = getattr(_usage_local, 'conn', None)
+    if conn is not None or _usage_db_failed:
+        return conn
+    with _usage_lock:
+        if _usage_db_failed:
+            return None
+        if sqlite3 is None or USAGE_BACKEND != 'sqlite':
+            _usage_db_failed = True
+            return None
+        try:
+            conn = sqlite3.connect(USAGE_DB_FILE, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            if not _usage_db_ready:
+                conn.execute('CREATE TABLE IF NOT EXISTS usage (owner_uid TEXT NOT NULL, buyer_id TEXT NOT NULL, cmd TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0, reset_time INTEGER, PRIMARY KEY (owner_uid, buyer_id, cmd)) WITHOUT ROWID')
+                conn.execute('CREATE INDEX IF NOT EXISTS usage_reset_time ON usage (reset_time)')
+                conn.execute('CREATE TABLE IF NOT EXISTS queue_rows (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+                conn.execute('CREATE TABLE IF NOT EXISTS outbox_records (key TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID')
+                _migrate_usage_json(conn)
+                _migrate_store_json(conn, 'queue_rows', QUEUE_FILE)
+                _migrate_store_json(conn, 'outbox_records', OUTBOX_FILE)
+                _usage_db_ready = True
+        except Exception as e:
+            _usage_db_failed = True
+            logger.error(f'{PREFIX} usage database unavailable, using {USAGE_FILE}: {e}')
+            return None
+    _usage_local.conn = conn
+    return conn
+
+def _migrate_usage_json(conn):
+    usage = load_usage()
+    rows = []
+    for owner_uid, buyers in (usage.items() if isinstance(usage, dict) else []):
+        for buyer_id, cmds in (buyers.items() if isinstance(buyers, dict) else []):
+            for cmd, record in (cmds.items() if isinstance(cmds, dict) else []):
+                if not isinstance(record, dict):
+                    continue
+                reset_time = record.get('reset_time')
+                rows.append((str(owner_uid), str(buyer_id), str(cmd), int(record.get('count') or 0), None if reset_time is None else int(reset_time)))
+    if not rows:
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany('INSERT OR REPLACE INTO usage (owner_uid, buyer_id, cmd, count, reset_time) VALUES (?, ?, ?, ?, ?)', rows)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    os.replace(USAGE_FILE, USAGE_FILE + '.bak')
+    _save_json(USAGE_FILE, {})
+    logger.info(f'{PREFIX} usage.json migrated to {USAGE_DB_FILE}: {len(rows)} records')
+
+def _migrate_store_json(conn, table: str, path: str):
+    raw = _load_json(path) if os.path.exists(path) else {}
+    rows = [(str(key), _store_dump(value)) for key, value in (raw.items() if isinstance(raw, dict) else []) if isinstance(value, dict)]
+    if not rows:
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.executemany(f'INSERT OR REPLACE INTO {table} (key, value) VALUES (?, ?)', rows)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    os.replace(path, path + '.bak')
+    _save_json(path, {})
+    logger.info(f'{PREFIX} {os.path.basename(path)} migrated to {USAGE_DB_FILE}: {len(rows)} records')
+
+def _store_dump(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+def _store_load(table: str, path: str) -> dict:
+    conn = _usage_db()
+    if conn is None:
+        return _load_json(path) if os.path.exists(path) else {}
+    rows = {}
+    for key, value in conn.execute(f'SELECT key, value FROM {table}'):
+        try:
+            rows[key] = json.loads(value)
+        except ValueError:
+            continue
+    return rows
+
+def _store_write(conn, table: str, collect):
+    if not conn.in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            _store_write(conn, table, collect)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return
+    rows = collect()
+    conn.executemany(f'INSERT OR REPLACE INTO {table} (key, value) VALUES (?, ?)', [(key, value) for key, value in rows.items() if value is not None])
+    conn.executemany(f'DELETE FROM {table} WHERE key = ?', [(key,) for key, value in rows.items() if value is None])
+
+def _store_in_transaction():
+    conn = _usage_db()
+    return conn if conn is not None and conn.in_transaction else None
+
+def _usage_db_record(conn, owner_uid: str, buyer_id: str, cmd: str) -> dict:
+    row = conn.execute('SELECT count, reset_time FROM usage WHERE owner_uid = ? AND buyer_id = ? AND cmd = ?', (owner_uid, buyer_id, cmd)).fetchone()
+    if row is None:
+        return {'count': 0}
+    record = {'count': int(row[0] or 0)}
+    if row[1] is not None:
+        record['reset_time'] = int(row[1])
+    return record
+
+def _usage_db_store(conn, owner_uid: str, buyer_id: str, cmd: str, record: dict):
+    conn.execute('INSERT OR REPLACE INTO usage (owner_uid, buyer_id, cmd, count, reset_time) VALUES (?, ?, ?, ?, ?)', (owner_uid, buyer_id, cmd, int(record.get('count') or 0), record.get('reset_time')))
+
+def _sweep_usage(now: Optional[int]=None) -> int:
+    now = int(_steam_time()) if now is None else int(now)
+    conn = _usage_db()
+    if conn is not None:
+        return conn.execute('DELETE FROM usage WHERE reset_time IS NOT NULL AND reset_time < ?', (now,)).rowcount
+    with _usage_lock:
+        usage = load_usage()
+        removed = 0
+        for owner_uid in list(usage.keys()):
+            buyers = usage.get(owner_uid)
+            if not isinstance(buyers, dict):
+                continue
+            for buyer_id in list(buyers.keys()):
+                cmds = buyers.get(buyer_id)
+                if not isinstance(cmds, dict):
+                    continue
+                for cmd in list(cmds.keys()):
+                    record = cmds.get(cmd)
+                    if isinstance(record, dict) and record.get('reset_time') is not None and int(record['reset_time']) < now:
+                        del cmds[cmd]
+                        removed += 1
+                if not cmds:
+                    del buyers[buyer_id]
+            if not buyers:
+                del usage[owner_uid]
+        if removed:
+            save_usage(usage)
+        return removed
+
+def _usage_sweeper_worker():
+    while True:
+        time.sleep(USAGE_SWEEP_INTERVAL)
+        try:
+            removed = _sweep_usage()
+            if removed:
+                logger.debug(f'{PREFIX} usage sweep removed {removed} expired records')
+        except Exception as e:
+            logger.warning(f'{PREFIX} usage sweep failed: {e}')
+
+def _start_usage_sweeper():
+    global _usage_sweeper_started
+    with _usage_lock:
+        if _usage_sweeper_started:
+            return
+        _usage_sweeper_started = True
+    threading.Thread(target=_usage_sweeper_worker, name='SDA-USAGE-SWEEP', daemon=True).start()
+
+def _log_path(owner_uid: str) -> str:
+    return os.path.join(LOGS_DIR, re.sub('[^0-9A-Za-z_-]', '_', str(owner_uid)) + '.jsonl')
+
+def _encode_log_line(entry: dict) -> bytes:
+    return (json.dumps(entry, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+
+def _migrate_legacy_logs():
+    global _logs_migrated
+    if _logs_migrated:
+        return
+    _logs_migrated = True
+    if not os.path.exists(LOGS_FILE):
+        return
+    marker = LOGS_FILE + '.migrating'
+    try:
+        os.makedirs(LOGS_DIR, exist_ok=True)
+        if os.path.exists(marker):
+            owners = _load_json(marker).get('owners') or []
+        else:
+            legacy = _load_json(LOGS_FILE)
+            owners = []
+            for owner_uid, arr in (legacy.items() if isinstance(legacy, dict) else []):
+                if not isinstance(arr, list) or not arr:
+                    continue
+                path = _log_path(owner_uid)
+                tail = b''
+                if os.path.exists(path):
+                    with open(path, 'rb') as f:
+                        tail = f.read()
+                with open(path + '.tmp', 'wb') as f:
+                    for entry in arr:
+                        if isinstance(entry, dict):
+                            f.write(_encode_log_line(entry))
+                    f.write(tail)
+                owners.append(str(owner_uid))
+            if not _save_json(marker, {'owners': owners}):
+                return
+        for owner_uid in owners:
+            path = _log_path(owner_uid)
+            if os.path.exists(path + '.tmp'):
+                os.replace(path + '.tmp', path)
+        os.replace(LOGS_FILE, LOGS_FILE + '.bak')
+        os.remove(marker)
+        _log_index.clear()
+    except Exception as e:
+        logger.error(f'{PREFIX} legacy logs migration error: {e}')
+
+def _log_store_index(owner_uid: str) -> dict:
+    _migrate_legacy_logs()
+    path = _log_path(owner_uid)
+    stamp = _file_stamp(path)
+    idx = _log_index.get(owner_uid)
+    if idx is not None and idx['stamp'] == stamp:
+        return idx
+    offsets = []
+    end = 0
+    if stamp is not None:
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                if line.strip():
+                    offsets.append(end)
+                end += len(line)
+        if end != stamp[1]:
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+            stamp = _file_stamp(path)
+    idx = {'offsets': offsets, 'end': end, 'stamp': stamp}
+    _log_index[owner_uid] = idx
+    return idx
+
+def _compact_log_store(owner_uid: str, idx: dict, keep: int):
+    offsets = idx['offsets']
+    if len(offsets) <= keep:
+        return
+    start = offsets[-keep]
+    path = _log_path(owner_uid)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        blob = f.read(idx['end'] - start)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(blob)
+    os.replace(path + '.tmp', path)
+    idx['offsets'] = [off - start for off in offsets[-keep:]]
+    idx['end'] = len(blob)
+    idx['stamp'] = _file_stamp(path)
+
+def _max_logs_setting() -> int:
+    cfg = _read_cfg()
+    try:
+        max_logs = int(cfg.get('max_logs') or 1000)
+    except (TypeError, ValueError):
+        max_logs = 1000
+    return max(500, min(max_logs, 5000))
+
+def _log_count(owner_uid: str) -> int:
+    _flush_pending_logs()
+    with _logs_lock:
+        try:
+            return min(len(_log_store_index(str(owner_uid))['offsets']), _max_logs_setting())
+        except Exception as e:
+            logger.error(f'{PREFIX} log count error: {e}')
+            return 0
+
+def _read_log_page(owner_uid: str, page: int, per_page: int) -> tuple:
+    owner_uid = str(owner_uid)
+    _flush_pending_logs()
+    with _logs_lock:
+        try:
+            idx = _log_store_index(owner_uid)
+            offsets = idx['offsets'][-_max_logs_setting():]
+            total = len(offsets)
+            total_pages = max(1, (total + per_page - 1) // per_page)
+            page = max(0, min(int(page), total_pages - 1))
+            hi = total - page * per_page
+            lo = max(0, hi - per_page)
+            if hi <= lo:
+                return (total, page, total_pages, [])
+            stop = offsets[hi] if hi < total else idx['end']
+            with open(_log_path(owner_uid), 'rb') as f:
+                f.seek(offsets[lo])
+                blob = f.read(stop - offsets[lo])
+        except Exception as e:
+            logger.error(f'{PREFIX} read logs error: {e}')
+            return (0, 0, 1, [])
+    entries = []
+    for line in blob.splitlines():
+        try:
+            entry = json.loads(line)
+        except Exception:
+            continue
+        if isinstance(entry, dict):
+            entries.append(entry)
+    entries.reverse()
+    return (total, page, total_pages, entries)
+
+def _queue_item_key(item: Mapping) -> tuple:
+    return (str(item.get('buyer_id') or ''), str(item.get('owner_uid') or ''), str(item.get('command') or ''))
+
+class _BuyerQueue:
+    __slots__ = ('_entries', '_index', '_removed', '_seq')
+
+    def __init__(self, items=()):
+        self._entries = deque()
+        self._index: Dict[tuple, list] = {}
+        self._removed: List[int] = []
+        self._seq = 0
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __bool__(self):
+        return bool(self._index)
+
+    def __iter__(self):
+        return iter(self.items())
+
+    def _trim(self):
+        while self._entries and (not self._entries[0][2]):
+            self._entries.popleft()
+            del self._removed[0]
+
+    def append(self, item: dict) -> int:
+        key = _queue_item_key(item)
+        if key in self._index:
+            return self.position(key)
+        self._seq += 1
+        entry = [self._seq, item, True]
+        self._entries.append(entry)
+        self._index[key] = entry
+        return len(self._index)
+
+    def peek(self) -> Optional[dict]:
+        self._trim()
+        return self._entries[0][1] if self._entries else None
+
+    def popleft(self) -> dict:
+        self._trim()
+        entry = self._entries.popleft()
+        del self._index[_queue_item_key(entry[1])]
+        self._trim()
+        return entry[1]
+
+    def position(self, key: tuple) -> Optional[int]:
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        self._trim()
+        return entry[0] - self._entries[0][0] + 1 - bisect_left(self._removed, entry[0])
 
-def save_logs(data: dict):
-    _save_json(LOGS_FILE, data)
+    def remove(self, key: tuple) -> Optional[dict]:
+        entry = self._index.pop(key, None)
+        if entry is None:
+            return None
+        entry[2] = False
+        insort(self._removed, entry[0])
+        self._trim()
+        return entry[1]
+
+    def items(self) -> List[dict]:
+        return [entry[1] for entry in self._entries if entry[2]]
+
+def _queue_item_from_raw(raw) -> Optional[dict]:
+    if isinstance(raw, (list, tuple)):
+        item = dict(zip(_QUEUE_ITEM_FIELDS, raw))
+    elif isinstance(raw, dict):
+        item = {field: raw.get(field) for field in _QUEUE_ITEM_FIELDS}
+    else:
+        return None
+    item['buyer_id'] = str(item.get('buyer_id') or '')
+    if not item['buyer_id']:
+        return None
+    try:
+        item['enqueued_at'] = int(item.get('enqueued_at') or _steam_time())
+    except (TypeError, ValueError):
+        return None
+    item['command'] = str(item.get('command') or '')
+    item['account_id'] = str(item.get('account_id') or '')
+    item['owner_uid'] = str(item.get('owner_uid') or '')
+    return item
 
 def load_queue() -> dict:
-    return _load_json(QUEUE_FILE)
+    global _queue_state
+    if _queue_state is not None:
+        return _queue_state
+    with _queue_lock:
+        if _queue_state is None:
+            raw = _store_load('queue_rows', QUEUE_FILE)
+            state = {}
+            legacy = []
+            for key, st in (raw.items() if isinstance(raw, dict) else []):
+                if not isinstance(st, dict):
+                    continue
+                st = dict(st)
+                items = st.get('queue') if isinstance(st.get('queue'), list) else []
+                st['queue'] = _BuyerQueue(filter(None, map(_queue_item_from_raw, items)))
+                if str(key).startswith('slot::'):
+                    state[str(key)] = st
+                else:
+                    legacy.append((str(key), st))
+            for key, st in legacy:
+                owner_uid, acc = _account_key_index().get(key) or (None, None)
+                if acc is None:
+                    continue
+                items = st['queue'].items()
+                for item in items:
+                    item['owner_uid'] = item['owner_uid'] or owner_uid
+                    item['account_id'] = item['account_id'] or str(acc.get('account_id') or '')
+                target = state.setdefault(_slot_key(acc), st)
+                if target is st:
+                    st['queue'] = _BuyerQueue(items)
+                else:
+                    for item in items:
+                        target['queue'].append(item)
+            _queue_rows.clear()
+            _queue_rows.update({key: _queue_row(st) for key, st in state.items()})
+            if legacy:
+                _queue_dirty.update(key for key, _ in legacy)
+                _queue_dirty.update(state)
+            _queue_state = state
+        return _queue_state
+
+def _queue_row(st: dict) -> dict:
+    row = {k: v for k, v in st.items() if k != 'queue'}
+    queue = st.get('queue')
+    row['queue'] = [[item.get(field) for field in _QUEUE_ITEM_FIELDS] for item in (queue.items() if isinstance(queue, _BuyerQueue) else [])]
+    return row
+
+def save_queue(data: dict, keys=None):
+    if keys is None:
+        keys = list(data) + [key for key in _queue_rows if key not in data]
+    changed = []
+    for key in keys:
+        st = data.get(key)
+        row = _queue_row(st) if isinstance(st, dict) else None
+        if _queue_rows.get(key) == row:
+            continue
+        if row is None:
+            _queue_rows.pop(key, None)
+        else:
+            _queue_rows[key] = row
+        changed.append(key)
+    if not changed:
+        return
+    conn = _store_in_transaction()
+    if conn is not None:
+        _store_write(conn, 'queue_rows', lambda: {key: _queue_row_dump(key) for key in changed})
+        _queue_dirty.difference_update(changed)
+        return
+    _queue_dirty.update(changed)
+    uow = _active_unit_of_work()
+    if uow is not None:
+        uow.queue = True
+        return
+    _flush_queue()
+
+def _queue_row_dump(key: str) -> Optional[str]:
+    row = _queue_rows.get(key)
+    return None if row is None else _store_dump(row)
+
+def _flush_queue():
+    with _queue_lock:
+        if not _queue_dirty:
+            return
+        keys = []
+
+        def collect():
+            while _queue_dirty:
+                keys.append(_queue_dirty.pop())
+            return {key: _queue_row_dump(key) for key in keys}
+        try:
+            conn = _usage_db()
+            if conn is not None:
+                _store_write(conn, 'queue_rows', collect)
+                return
+            collect()
+            with open(QUEUE_FILE + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(dict(_queue_rows), f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(QUEUE_FILE + '.tmp', QUEUE_FILE)
+        except Exception as e:
+            _queue_dirty.update(keys)
+            logger.error(f'{PREFIX} queue store error: {e}')
 
-def save_queue(data: dict):
-    _save_json(QUEUE_FILE, data)
+def _unit_of_work() -> _UnitOfWork:
+    uow = getattr(_uow_local, 'uow', None)
+    if uow is None:
+        uow = _uow_local.uow = _UnitOfWork()
+    return uow
+
+def _active_unit_of_work() -> Optional[_UnitOfWork]:
+    uow = getattr(_uow_local, 'uow', None)
+    return uow if uow is not None and uow.depth else None
 
 def _default_cfg() -> dict:
     return {'template': '✅ Ваш код: {code}\n📊 Осталось: {left}/{total}', 'template_mode': 'global', 'max_logs': 1000, 'plugin_enabled': True, 'queue_enabled': True, 'command_notifications_enabled': True, 'command_notifications_debug_enabled': True, 'instruction_acknowledged_chat_ids': [], 'blacklist_enabled': False, 'blacklist_scope': 'all', 'blacklist_nicks': [], 'blacklist_account_ids': [], 'blacklist_text': '⛔ Вы находитесь в чёрном списке.\nВыдача Steam Guard кода для аккаунта «{name}» недоступна.'}
 
-def _get_cfg(data: dict) -> dict:
-    g = data.get('global')
+def _normalize_cfg(g) -> dict:
     base = _default_cfg()
-    if isinstance(g, dict):
+    if isinstance(g, Mapping):
         base.update(g)
     if str(base.get('template_mode') or 'global') not in {'global', 'custom'}:
         base['template_mode'] = 'global'
     if str(base.get('blacklist_scope') or 'all') not in {'all', 'selected'}:
         base['blacklist_scope'] = 'all'
-    if not isinstance(base.get('blacklist_nicks'), list):
+    if not isinstance(base.get('blacklist_nicks'), (list, tuple)):
         base['blacklist_nicks'] = []
     base['blacklist_nicks'] = [str(x).strip() for x in base.get('blacklist_nicks', []) if str(x or '').strip()]
-    if not isinstance(base.get('blacklist_account_ids'), list):
+    if not isinstance(base.get('blacklist_account_ids'), (list, tuple)):
         base['blacklist_account_ids'] = []
     base['blacklist_account_ids'] = [str(x).strip() for x in base.get('blacklist_account_ids', []) if str(x or '').strip()]
-    if not isinstance(base.get('instruction_acknowledged_chat_ids'), list):
+    if not isinstance(base.get('instruction_acknowledged_chat_ids'), (list, tuple)):
         base['instruction_acknowledged_chat_ids'] = []
     base['instruction_acknowledged_chat_ids'] = [str(x).strip() for x in base.get('instruction_acknowledged_chat_ids', []) if str(x or '').strip()]
     if not str(base.get('blacklist_text') or '').strip():
         base['blacklist_text'] = _default_cfg()['blacklist_text']
-    data['global'] = base
+    return base
+
+class _Config(Mapping):
+    __slots__ = ('_values', 'blacklist_nicks', 'blacklist_account_ids', 'acknowledged_chat_ids')
+
+    def __init__(self, values: dict):
+        self._values: Mapping = _freeze(values)
+        nicks: Dict[str, str] = {}
+        for nick in values['blacklist_nicks']:
+            nicks.setdefault(_normalize_nick(nick), nick)
+        nicks.pop('', None)
+        self.blacklist_nicks: Mapping = MappingProxyType(nicks)
+        self.blacklist_account_ids = frozenset(values['blacklist_account_ids'])
+        self.acknowledged_chat_ids = frozenset(values['instruction_acknowledged_chat_ids'])
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+def _get_cfg(data: dict) -> dict:
+    data['global'] = _normalize_cfg(data.get('global'))
     return data['global']
 
+def _build_cfg(data: Mapping) -> _Config:
+    return _Config(_normalize_cfg(data.get('global')))
+
+def _read_cfg(data: Optional[Mapping]=None) -> _Config:
+    return _snapshot_derived('cfg', _build_cfg, data)
+
 def _set_cfg(cfg: dict):
     data = load_data()
     data['global'] = cfg
     save_data(data)
 
 def _plugin_enabled() -> bool:
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     return bool(cfg.get('plugin_enabled', True))
 
 def _toggle_plugin_enabled() -> bool:
@@ -261,8 +1047,7 @@ def _toggle_plugin_enabled() -> bool:
     return bool(cfg['plugin_enabled'])
 
 def _queue_enabled() -> bool:
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     return bool(cfg.get('queue_enabled', True))
 
 def _toggle_queue_enabled() -> bool:
@@ -274,8 +1059,7 @@ def _toggle_queue_enabled() -> bool:
     return bool(cfg['queue_enabled'])
 
 def _command_notifications_enabled() -> bool:
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     return bool(cfg.get('command_notifications_enabled', True))
 
 def _toggle_command_notifications_enabled() -> bool:
@@ -287,8 +1071,7 @@ def _toggle_command_notifications_enabled() -> bool:
     return bool(cfg['command_notifications_enabled'])
 
 def _command_notifications_debug_enabled() -> bool:
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     return bool(cfg.get('command_notifications_debug_enabled', True))
 
 def _toggle_command_notifications_debug_enabled() -> bool:
@@ -300,8 +1083,7 @@ def _toggle_command_notifications_debug_enabled() -> bool:
     return bool(cfg['command_notifications_debug_enabled'])
 
 def _template_mode() -> str:
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     mode = str(cfg.get('template_mode') or 'global')
     return mode if mode in {'global', 'custom'} else 'global'
 
@@ -355,10 +1137,15 @@ def _get_accounts_for(chat_id: int, data: dict) -> List[dict]:
     uid = str(chat_id)
     arr = data.get(uid)
     if isinstance(arr, list):
-        _ensure_account_ids(uid, arr)
         return arr
     return []
 
+def _view_accounts_for(chat_id: int, data: Optional[Mapping]=None) -> tuple:
+    if data is None:
+        data = _data_view()
+    arr = data.get(str(chat_id))
+    return arr if isinstance(arr, tuple) else ()
+
 def _set_accounts_for(chat_id: int, data: dict, accounts: List[dict]):
     uid = str(chat_id)
     _ensure_account_ids(uid, accounts)
@@ -408,26 +1195,60 @@ def _push_log(owner_uid: str, entry: dict):
                 clean[key] = str(value)
             if isinstance(clean[key], str) and len(clean[key]) > 1500:
                 clean[key] = clean[key][:1497] + '…'
-        with _logs_lock:
-            logs = load_logs()
-            arr = logs.get(owner_uid)
-            if not isinstance(arr, list):
-                arr = []
-            arr.append(clean)
-            data = load_data()
-            cfg = _get_cfg(data)
-            try:
-                max_logs = int(cfg.get('max_logs') or 1000)
-            except (TypeError, ValueError):
-                max_logs = 1000
-            max_logs = max(500, min(max_logs, 5000))
-            if len(arr) > max_logs:
-                arr = arr[-max_logs:]
-            logs[owner_uid] = arr
-            save_logs(logs)
+        _log_pending.append((owner_uid, _encode_log_line(clean)))
+        _start_store_flusher()
     except Exception as e:
         logger.error(f'{PREFIX} push_log error: {e}')
 
+def _flush_pending_logs():
+    with _logs_lock:
+        lines = []
+        while _log_pending:
+            lines.append(_log_pending.popleft())
+        if lines:
+            _append_log_lines(lines)
+
+def _store_flush_worker():
+    while True:
+        time.sleep(STORE_FLUSH_INTERVAL)
+        try:
+            _flush_outbox()
+            _flush_pending_logs()
+        except Exception as e:
+            logger.error(f'{PREFIX} store flush error: {e}')
+
+def _start_store_flusher():
+    global _store_flusher_started
+    if _store_flusher_started:
+        return
+    with _logs_lock:
+        if _store_flusher_started:
+            return
+        _store_flusher_started = True
+    threading.Thread(target=_store_flush_worker, name='SDA-STORE-FLUSH', daemon=True).start()
+
+def _append_log_lines(lines: List[tuple]):
+    grouped: Dict[str, List[bytes]] = {}
+    for owner_uid, line in lines:
+        grouped.setdefault(owner_uid, []).append(line)
+    max_logs = _max_logs_setting()
+    with _logs_lock:
+        for owner_uid, chunk in grouped.items():
+            try:
+                idx = _log_store_index(owner_uid)
+                path = _log_path(owner_uid)
+                os.makedirs(LOGS_DIR, exist_ok=True)
+                with open(path, 'ab') as f:
+                    f.write(b''.join(chunk))
+                for line in chunk:
+                    idx['offsets'].append(idx['end'])
+                    idx['end'] += len(line)
+                idx['stamp'] = _file_stamp(path)
+                if len(idx['offsets']) > max_logs + max(100, max_logs // 5):
+                    _compact_log_store(owner_uid, idx, max_logs)
+            except Exception as e:
+                logger.error(f'{PREFIX} push_log error: {e}')
+
 def _log_event(owner_uid: str, event_type: str, message: str, **details):
     entry = {'ts': int(time.time()), 'type': str(event_type or 'INFO').upper(), 'msg': str(message or '')}
     for key, value in details.items():
@@ -437,11 +1258,8 @@ def _log_event(owner_uid: str, event_type: str, message: str, **details):
 
 def _log_error_for_all_owners(where: str, error: Exception):
     try:
-        data = load_data()
-        for owner_uid, accounts in (data or {}).items():
-            if owner_uid == 'global' or not isinstance(accounts, list):
-                continue
-            _log_event(str(owner_uid), 'ERROR', f'Ошибка в {where}: {type(error).__name__}: {error}', where=where)
+        for owner_uid, _ in list(_iter_owner_accounts()):
+            _log_event(owner_uid, 'ERROR', f'Ошибка в {where}: {type(error).__name__}: {error}', where=where)
     except Exception:
         pass
 
@@ -450,10 +1268,36 @@ class _SafeDict(dict):
     def __missing__(self, key):
         return ''
 
+def _compile_template(tpl: str) -> Optional[tuple]:
+    try:
+        return _template_cache[tpl]
+    except KeyError:
+        pass
+    parts = []
+    try:
+        for literal, field, spec, conversion in string.Formatter().parse(tpl):
+            if field is not None and (spec or conversion or not field.isidentifier()):
+                parts = None
+                break
+            parts.append((literal, field))
+    except ValueError:
+        parts = None
+    if len(_template_cache) >= TEMPLATE_CACHE_SIZE:
+        _template_cache.clear()
+    parts = tuple(parts) if parts is not None else None
+    _template_cache[tpl] = parts
+    return parts
+
 def _render_template(tpl: str, mapping: dict) -> str:
     tpl = (tpl or '').strip()
     if not tpl:
         tpl = _default_cfg()['template']
+    parts = _compile_template(tpl)
+    if parts is not None:
+        try:
+            return ''.join((literal if field is None else literal + format(mapping.get(field, ''), '') for literal, field in parts))
+        except Exception:
+            pass
     try:
         return tpl.format_map(_SafeDict(mapping))
     except Exception:
@@ -492,28 +1336,24 @@ def _parse_blacklist_nicks(raw: str) -> List[str]:
         result.append(nick)
     return result
 
-def _blacklist_match(cfg: dict, buyer_nick: str) -> Optional[str]:
+def _blacklist_match(cfg: _Config, buyer_nick: str) -> Optional[str]:
     buyer_norm = _normalize_nick(buyer_nick)
     if not buyer_norm:
         return None
-    for nick in cfg.get('blacklist_nicks') or []:
-        if _normalize_nick(str(nick)) == buyer_norm:
-            return str(nick)
-    return None
+    return cfg.blacklist_nicks.get(buyer_norm)
 
 def _blacklist_scope_label(scope: Optional[str]=None) -> str:
     scope = str(scope or 'all')
     return 'выбранные аккаунты' if scope == 'selected' else 'все аккаунты'
 
-def _blacklist_applies_to_account(owner_uid: str, acc: dict, cfg: dict) -> bool:
+def _blacklist_applies_to_account(owner_uid: str, acc: dict, cfg: _Config) -> bool:
     if not bool(cfg.get('blacklist_enabled', False)):
         return False
     scope = str(cfg.get('blacklist_scope') or 'all')
     if scope == 'all':
         return True
-    selected = set((str(x) for x in cfg.get('blacklist_account_ids') or []))
     acc_id = str(acc.get('account_id') or '').strip()
-    return bool(acc_id and acc_id in selected)
+    return bool(acc_id and acc_id in cfg.blacklist_account_ids)
 
 def _get_buyer_nick_from_event_message(event_msg) -> str:
     direct_attrs = ('author', 'author_name', 'sender_name', 'username', 'user_name', 'from_username', 'nickname', 'nick', 'login', 'buyer', 'buyer_username', 'buyer_name')
@@ -539,7 +1379,7 @@ def _get_buyer_nick_from_event_message(event_msg) -> str:
             pass
     return ''
 
-def _try_blacklist_reject(cardinal: 'Cardinal', owner_uid: str, acc: dict, buyer_id: str, buyer_nick: str, chat_id, cmd: str, cfg: dict) -> bool:
+def _try_blacklist_reject(cardinal: 'Cardinal', owner_uid: str, acc: dict, buyer_id: str, buyer_nick: str, chat_id, cmd: str, cfg: _Config) -> bool:
     if not _blacklist_applies_to_account(owner_uid, acc, cfg):
         return False
     matched_nick = _blacklist_match(cfg, buyer_nick)
@@ -548,27 +1388,115 @@ def _try_blacklist_reject(cardinal: 'Cardinal', owner_uid: str, acc: dict, buyer
     now = int(time.time())
     tpl = str(cfg.get('blacklist_text') or _default_cfg()['blacklist_text'])
     msg = _render_template(tpl, {'nick': buyer_nick, 'buyer_id': buyer_id, 'matched_nick': matched_nick, 'name': str(acc.get('name') or ''), 'command': cmd})
-    cardinal.account.send_message(chat_id, msg)
-    _push_log(owner_uid, {'ts': now, 'type': 'BLACKLIST', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'nick': buyer_nick, 'msg': f'отклонён по чёрному списку: {matched_nick}'})
+    _send_to_buyer(cardinal, chat_id, msg, owner_uid, {'ts': now, 'type': 'BLACKLIST', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'nick': buyer_nick, 'msg': f'отклонён по чёрному списку: {matched_nick}'})
     return True
 
 def _account_template_state(acc: dict) -> str:
     return 'свой' if str(acc.get('template') or '').strip() else 'общий'
 
-def generate_steam_guard_code(shared_secret: str) -> Optional[str]:
-    try:
-        key = base64.b64decode(shared_secret)
-        timestamp = int(time.time()) // 30
-        msg = timestamp.to_bytes(8, byteorder='big')
-        hmac_result = hmac.new(key, msg, digestmod='sha1').digest()
-        offset = hmac_result[-1] & 15
-        code_bytes = hmac_result[offset:offset + 4]
-        full_code = int.from_bytes(code_bytes, byteorder='big') & 2147483647
-        chars = '23456789BCDFGHJKMNPQRTVWXY'
-        code = ''
-        for _ in range(5):
-            code += chars[full_code % len(chars)]
-            full_code //= len(chars)
+_totp_lock = threading.Lock()
+_totp_keys: Dict[str, bytes] = {}
+_totp_codes: Dict[tuple, str] = {}
+TOTP_CODE_CHARS = '23456789BCDFGHJKMNPQRTVWXY'
+TOTP_PREWARM_LEAD = 1.0
+
+def _secret_fingerprint(shared_secret: str) -> str:
+    return hashlib.sha256(str(shared_secret or '').strip().encode('utf-8')).hexdigest()[:16]
+
+def _totp_key(shared_secret: str) -> tuple:
+    fp = _secret_fingerprint(shared_secret)
+    key = _totp_keys.get(fp)
+    if key is None:
+        key = base64.b64decode(str(shared_secret or '').strip())
+        with _totp_lock:
+            _totp_keys[fp] = key
+    return (fp, key)
+
+def _totp_compute(key: bytes, window: int) -> str:
+    hmac_result = hmac.new(key, window.to_bytes(8, byteorder='big'), digestmod='sha1').digest()
+    offset = hmac_result[-1] & 15
+    full_code = int.from_bytes(hmac_result[offset:offset + 4], byteorder='big') & 2147483647
+    chars = TOTP_CODE_CHARS
+    return chars[full_code % 26] + chars[full_code // 26 % 26] + chars[full_code // 676 % 26] + chars[full_code // 17576 % 26] + chars[full_code // 456976 % 26]
+
+def _store_totp_code(fp: str, window: int, code: str):
+    with _totp_lock:
+        _totp_codes[fp, window] = code
+        if len(_totp_codes) > 4 * len(_totp_keys) + 16:
+            for item in [item for item in _totp_codes if item[1] < window - 1]:
+                del _totp_codes[item]
+
+def generate_steam_guard_codes(shared_secrets, windows=None) -> Dict[str, Optional[Dict[int, str]]]:
+    if windows is None:
+        windows = (int(_steam_time()) // 30,)
+    elif isinstance(windows, int):
+        windows = (windows,)
+    keys = []
+    result: Dict[str, Optional[Dict[int, str]]] = {}
+    for secret in shared_secrets:
+        secret = str(secret or '').strip()
+        if secret in result:
+            continue
+        try:
+            fp, key = _totp_key(secret)
+        except Exception:
+            result[secret] = None
+            continue
+        keys.append((secret, fp, key))
+        result[secret] = {}
+    cached = _totp_codes
+    fresh = {}
+    for secret, fp, key in keys:
+        codes = result[secret]
+        for window in windows:
+            code = cached.get((fp, window))
+            if code is None:
+                code = _totp_compute(key, window)
+                fresh[fp, window] = code
+            codes[window] = code
+    if fresh:
+        with _totp_lock:
+            cached.update(fresh)
+            oldest = min(windows) - 1
+            if len(cached) > 4 * len(_totp_keys) + 16:
+                for item in [item for item in cached if item[1] < oldest]:
+                    del cached[item]
+    return result
+
+def _enabled_account_secrets(data: Optional[Mapping]=None) -> tuple:
+    def build(view):
+        secrets = []
+        for _, accounts in _iter_owner_accounts(view):
+            for acc in accounts:
+                if isinstance(acc, Mapping) and acc.get('enabled', True) and acc.get('shared_secret'):
+                    secrets.append(str(acc.get('shared_secret')))
+        return tuple(dict.fromkeys(secrets))
+    return _snapshot_derived('enabled_secrets', build, data)
+
+def _prewarm_totp_codes(window: int):
+    generate_steam_guard_codes(_enabled_account_secrets(), (window,))
+
+def _prune_totp_cache(data):
+    keep = set()
+    for _, accounts in _iter_owner_accounts(data):
+        for acc in accounts:
+            if isinstance(acc, Mapping) and acc.get('shared_secret'):
+                keep.add(_secret_fingerprint(str(acc.get('shared_secret'))))
+    with _totp_lock:
+        for fp in [fp for fp in _totp_keys if fp not in keep]:
+            del _totp_keys[fp]
+        for item in [item for item in _totp_codes if item[0] not in keep]:
+            del _totp_codes[item]
+
+def generate_steam_guard_code(shared_secret: str, window: Optional[int]=None) -> Optional[str]:
+    try:
+        fp, key = _totp_key(shared_secret)
+        if window is None:
+            window = int(_steam_time()) // 30
+        code = _totp_codes.get((fp, window))
+        if code is None:
+            code = _totp_compute(key, window)
+            _store_totp_code(fp, window, code)
         return code
     except Exception as e:
         logger.error(f'{PREFIX} generate code error: {e}')
@@ -653,7 +1581,7 @@ def _callback_action_label(data: str) -> str:
     exact = {CB_WELCOME: 'открыто главное меню', CB_INFO: 'открыта информация о плагине', CB_SETTINGS: 'открыты настройки', CB_INSTRUCTION_ACK: 'подтверждено прочтение инструкции', CB_UPDATE_PLUGIN: 'открыто меню обновления', CB_UPDATE_PLUGIN_LOCAL: 'запущено локальное обновление', CB_UPDATE_PLUGIN_ONLINE: 'запущена онлайн-проверка обновления', CB_UPDATE_PLUGIN_YES: 'подтверждена установка обновления', CB_UPDATE_PLUGIN_NO: 'обновление отменено', CB_ADD: 'запущено добавление аккаунта', CB_LIST: 'открыт список аккаунтов', CB_DEL_MENU: 'открыто удаление аккаунтов', CB_TEMPLATE: 'открыто редактирование общего текста', CB_CONFIG_MENU: 'открыто меню конфигурации', CB_CONFIG_EXPORT: 'нажато скачивание конфигурации', CB_CONFIG_IMPORT: 'запущен импорт конфигурации', CB_BL: 'открыт чёрный список', CB_BL_NICKS: 'открыто управление никами ЧС', CB_BL_NICK_ADD: 'нажато добавление ника в ЧС', CB_BL_TEXT: 'открыто редактирование текста ЧС', CB_BL_ACCS: 'открыт выбор аккаунтов для ЧС', CB_PLUGIN_TOGGLE: 'переключено состояние плагина', CB_QUEUE_TOGGLE: 'переключена общая очередь', CB_CMD_NOTIFY_TOGGLE: 'переключены общие уведомления команд', CB_CANCEL: 'операция отменена', CB_DELETE_PLUGIN: 'открыто удаление плагина', CB_DELETE_PLUGIN_YES: 'подтверждено удаление плагина', CB_DELETE_PLUGIN_NO: 'удаление плагина отменено'}
     if raw in exact:
         return exact[raw]
-    prefixes = [(CB_LOGS, 'открыта страница логов'), (CB_LIST_PAGE, 'переключена страница аккаунтов'), (CB_ACCOUNT_OPEN, 'открыта карточка аккаунта'), (CB_ACCOUNT_TOGGLE_ENABLED, 'переключена выдача кодов аккаунта'), (CB_ACCOUNT_TOGGLE_QUEUE, 'переключена очередь аккаунта'), (CB_ACCOUNT_TOGGLE_NOTIFY, 'переключены уведомления аккаунта'), (CB_ACCOUNT_EDIT_COMMAND, 'открыто изменение команды аккаунта'), (CB_ACCOUNT_TEXT_MENU, 'открыты настройки текста аккаунта'), (CB_ACCOUNT_TEXT_GLOBAL, 'выбран общий текст аккаунта'), (CB_ACCOUNT_TEXT_CUSTOM, 'открыто изменение личного текста аккаунта'), (CB_ACCOUNT_EDIT_SECRET, 'открыта замена secret/maFile'), (CB_ACCOUNT_EDIT_LIMIT, 'открыто изменение лимита аккаунта'), (CB_BL_NICK_PAGE, 'переключена страница ников ЧС'), (CB_BL_NICK_ADD, 'нажато добавление ника в ЧС'), (CB_BL_NICK_DEL, 'нажато удаление ника из ЧС'), (CB_BL_ACC_TOGGLE, 'переключён аккаунт для ЧС'), (CB_DEL_PICK, 'выбран аккаунт для удаления'), (CB_DEL_YES, 'подтверждено удаление аккаунта')]
+    prefixes = [(CB_LOGS, 'открыта страница логов'), (CB_LIST_PAGE, 'переключена страница аккаунтов'), (CB_ACCOUNT_OPEN, 'открыта карточка аккаунта'), (CB_ACCOUNT_TOGGLE_ENABLED, 'переключена выдача кодов аккаунта'), (CB_ACCOUNT_TOGGLE_QUEUE, 'переключена очередь аккаунта'), (CB_ACCOUNT_TOGGLE_NOTIFY, 'переключены уведомления аккаунта'), (CB_ACCOUNT_EDIT_COMMAND, 'открыто изменение команды аккаунта'), (CB_ACCOUNT_TEXT_MENU, 'открыты настройки текста аккаунта'), (CB_ACCOUNT_TEXT_GLOBAL, 'выбран общий текст аккаунта'), (CB_ACCOUNT_TEXT_CUSTOM, 'открыто изменение личного текста аккаунта'), (CB_ACCOUNT_EDIT_SECRET, 'открыта замена secret/maFile'), (CB_ACCOUNT_EDIT_LIMIT, 'открыто изменение лимита аккаунта'), (CB_ACCOUNT_EDIT_SLOTS, 'открыто изменение покупателей за окно'), (CB_BL_NICK_PAGE, 'переключена страница ников ЧС'), (CB_BL_NICK_ADD, 'нажато добавление ника в ЧС'), (CB_BL_NICK_DEL, 'нажато удаление ника из ЧС'), (CB_BL_ACC_TOGGLE, 'переключён аккаунт для ЧС'), (CB_DEL_PICK, 'выбран аккаунт для удаления'), (CB_DEL_YES, 'подтверждено удаление аккаунта')]
     for prefix, label in prefixes:
         if raw.startswith(f'{prefix}:'):
             return label
@@ -795,10 +1723,9 @@ def open_welcome(cardinal: 'Cardinal', call_or_msg):
         bot.send_message(chat_id, text, parse_mode='HTML', reply_markup=kb, disable_web_page_preview=True)
 
 def _settings_text(chat_id: int) -> str:
-    data = load_data()
-    cfg = _get_cfg(data)
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    data = _data_view()
+    cfg = _read_cfg(data)
+    accounts = _view_accounts_for(chat_id, data)
     tpl = (cfg.get('template') or '').strip()
     tpl_short = tpl[:120] + '…' if len(tpl) > 120 else tpl or '—'
     plugin_state = 'ВКЛ' if bool(cfg.get('plugin_enabled', True)) else 'ВЫКЛ'
@@ -826,18 +1753,16 @@ def _settings_kb() -> InlineKeyboardMarkup:
     return kb
 
 def _instruction_acknowledged(chat_id: int) -> bool:
-    data = load_data()
-    cfg = _get_cfg(data)
-    save_data(data)
-    return str(chat_id) in set(cfg.get('instruction_acknowledged_chat_ids') or [])
+    return str(chat_id) in _read_cfg().acknowledged_chat_ids
 
 def _set_instruction_acknowledged(chat_id: int):
     data = load_data()
     cfg = _get_cfg(data)
     ids = list(cfg.get('instruction_acknowledged_chat_ids') or [])
     uid = str(chat_id)
-    if uid not in ids:
-        ids.append(uid)
+    if uid in ids:
+        return
+    ids.append(uid)
     cfg['instruction_acknowledged_chat_ids'] = ids
     data['global'] = cfg
     save_data(data)
@@ -1127,8 +2052,7 @@ def cancel_online_plugin_update(cardinal: 'Cardinal', call):
     _safe_edit(bot, call.message.chat.id, _mid(call.message), '❌ <b>Обновление отменено.</b>\n\nФайл плагина и данные не изменены.', _update_menu_kb())
 
 def _config_menu_text(chat_id: int) -> str:
-    data = load_data()
-    accounts = _get_accounts_for(chat_id, data)
+    accounts = _view_accounts_for(chat_id)
     return f'📦 <b>Конфигурация плагина</b>\n\nАккаунтов в текущей конфигурации: <b>{len(accounts)}</b>.\n\n• <b>Скачать конфиг</b> — получить JSON-файл с общими настройками и аккаунтами.\n• <b>Импортировать</b> — заменить текущие настройки данными из JSON-файла.\n\n⚠️ Файл содержит <code>shared_secret</code>. Не передавайте его посторонним.'
 
 def _config_menu_kb() -> InlineKeyboardMarkup:
@@ -1149,10 +2073,9 @@ CONFIG_MAX_FILE_SIZE = 5 * 1024 * 1024
 CONFIG_MAX_ACCOUNTS = 500
 
 def _build_config_payload(chat_id: int) -> dict:
-    data = load_data()
-    cfg = _get_cfg(data)
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    data = _data_view()
+    cfg = _thaw(_read_cfg(data))
+    accounts = _thaw(_view_accounts_for(chat_id, data))
     return {'format': CONFIG_FORMAT, 'schema_version': CONFIG_SCHEMA_VERSION, 'plugin_version': VERSION, 'exported_at': int(time.time()), 'global': cfg, 'accounts': accounts}
 
 def export_config(cardinal: 'Cardinal', call):
@@ -1237,10 +2160,12 @@ def _validate_imported_config(payload: dict) -> tuple[dict, List[dict]]:
         raise ValueError(f'Слишком много аккаунтов. Максимум: {CONFIG_MAX_ACCOUNTS}.')
     cfg_box = {'global': dict(raw_cfg)}
     cfg = dict(_get_cfg(cfg_box))
+    cfg.pop('schema_version', None)
     cfg['template_mode'] = 'global'
     accounts: List[dict] = []
     used_commands = set()
     used_ids = set()
+    secret_codes = generate_steam_guard_codes((raw_acc.get('shared_secret') for raw_acc in raw_accounts if isinstance(raw_acc, dict)))
     for pos, raw_acc in enumerate(raw_accounts, start=1):
         if not isinstance(raw_acc, dict):
             raise ValueError(f'Аккаунт №{pos} имеет некорректную структуру.')
@@ -1253,14 +2178,14 @@ def _validate_imported_config(payload: dict) -> tuple[dict, List[dict]]:
             raise ValueError(f'У аккаунта №{pos} используется зарезервированная команда.')
         if command in used_commands:
             raise ValueError(f'Команда {command} встречается в конфиге несколько раз.')
-        if not generate_steam_guard_code(shared_secret):
+        if not secret_codes.get(shared_secret):
             raise ValueError(f'У аккаунта №{pos} невалидный shared_secret.')
         limit = _parse_import_positive_int(raw_acc.get('limit'), f'limit аккаунта №{pos}')
         if limit is None:
             period_hours = None
         else:
             period_hours = _parse_import_positive_int(raw_acc.get('period_hours'), f'period_hours аккаунта №{pos}')
-        acc = {'name': name or f'Аккаунт {pos}', 'command': command, 'shared_secret': shared_secret, 'limit': limit, 'period_hours': period_hours, 'template': str(raw_acc.get('template') or '').strip(), 'enabled': bool(raw_acc.get('enabled', True)), 'queue_enabled': bool(raw_acc.get('queue_enabled', True)), 'command_notifications_enabled': bool(raw_acc.get('command_notifications_enabled', True))}
+        acc = {'name': name or f'Аккаунт {pos}', 'command': command, 'shared_secret': shared_secret, 'limit': limit, 'period_hours': period_hours, 'template': str(raw_acc.get('template') or '').strip(), 'enabled': bool(raw_acc.get('enabled', True)), 'queue_enabled': bool(raw_acc.get('queue_enabled', True)), 'command_notifications_enabled': bool(raw_acc.get('command_notifications_enabled', True)), 'slots_per_window': _account_slots(raw_acc)}
         account_id = str(raw_acc.get('account_id') or '').strip()
         if re.fullmatch('[a-f0-9]{10}', account_id) and account_id not in used_ids:
             acc['account_id'] = account_id
@@ -1273,13 +2198,11 @@ def _validate_imported_config(payload: dict) -> tuple[dict, List[dict]]:
     return (cfg, accounts)
 
 def _clear_owner_runtime_queue(owner_uid: str):
-    prefix = f'{owner_uid}::'
-    with _queue_lock:
+    with _queue_stripes:
         queue_data = load_queue()
-        keys = [key for key in queue_data if str(key).startswith(prefix)]
-        for key in keys:
-            queue_data.pop(key, None)
-            _cancel_timer(key)
+        for key, st in list(queue_data.items()):
+            if isinstance(st, dict) and _remove_queue_items(st, lambda item: item.get('owner_uid') == str(owner_uid)) and (not st['queue']):
+                _cancel_timer(key)
         save_queue(queue_data)
 
 def _handle_config_import_document(message: Message, cardinal: 'Cardinal', st: dict):
@@ -1292,10 +2215,11 @@ def _handle_config_import_document(message: Message, cardinal: 'Cardinal', st: d
         data = load_data()
         data['global'] = cfg
         _set_accounts_for(chat_id, data, accounts)
-        save_data(data)
-        _clear_owner_runtime_queue(str(chat_id))
-        _cancel_all_queue_timers()
-        _reschedule_available_queues(cardinal)
+        with _queue_stripes:
+            save_data(data)
+            _clear_owner_runtime_queue(str(chat_id))
+            _cancel_all_queue_timers()
+            _reschedule_available_queues(cardinal)
         _log_event(str(chat_id), 'CONFIG', 'Конфигурация импортирована', accounts=len(accounts))
         _fsm.pop(chat_id, None)
         if panel_msg_id:
@@ -1311,10 +2235,9 @@ def _handle_config_import_document(message: Message, cardinal: 'Cardinal', st: d
             _safe_edit(bot, chat_id, panel_msg_id, '❌ Произошла ошибка при импорте конфигурации.', _cancel_kb(CB_CONFIG_MENU))
 
 def _blacklist_panel_text(chat_id: int) -> str:
-    data = load_data()
-    cfg = _get_cfg(data)
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    data = _data_view()
+    cfg = _read_cfg(data)
+    accounts = _view_accounts_for(chat_id, data)
     enabled = bool(cfg.get('blacklist_enabled', False))
     state = 'ВКЛ' if enabled else 'ВЫКЛ'
     nicks = cfg.get('blacklist_nicks') or []
@@ -1323,10 +2246,9 @@ def _blacklist_panel_text(chat_id: int) -> str:
         nicks_preview += f' … +{len(nicks) - 25}'
     if not nicks_preview:
         nicks_preview = '—'
-    selected_ids = set((str(x) for x in cfg.get('blacklist_account_ids') or []))
     selected_count = 0
     for acc in accounts:
-        if str(acc.get('account_id') or '') in selected_ids:
+        if str(acc.get('account_id') or '') in cfg.blacklist_account_ids:
             selected_count += 1
     scope = str(cfg.get('blacklist_scope') or 'all')
     scope_label = _blacklist_scope_label(scope)
@@ -1335,8 +2257,7 @@ def _blacklist_panel_text(chat_id: int) -> str:
     return f'🚫 <b>Чёрный список</b>\n\nСостояние: <b>{state}</b>\nПрименение: <b>{escape(scope_label)}</b>\nНиков в списке: <b>{len(nicks)}</b>\nВыбранных аккаунтов: <b>{selected_count}</b>\n\n💬 <b>Текст ответа:</b>\n<code>{escape(tpl_short)}</code>\n\n'
 
 def _blacklist_kb() -> InlineKeyboardMarkup:
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     kb = InlineKeyboardMarkup()
     state = 'ВКЛ' if bool(cfg.get('blacklist_enabled', False)) else 'ВЫКЛ'
     scope_label = _blacklist_scope_label(str(cfg.get('blacklist_scope') or 'all'))
@@ -1385,16 +2306,14 @@ def _clamp_blacklist_nick_page(total: int, page: int) -> tuple[int, int]:
     return (max(0, min(int(page), total_pages - 1)), total_pages)
 
 def _blacklist_nicks_text(chat_id: int, page: int=0, notice: str='') -> str:
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     nicks = list(cfg.get('blacklist_nicks') or [])
     page, total_pages = _clamp_blacklist_nick_page(len(nicks), page)
     prefix = f'{notice}\n\n' if notice else ''
     return prefix + '👤 <b>Ники чёрного списка</b>\n\n' + 'Добавляйте ники по одному. Чтобы удалить ник, нажмите кнопку с ним ниже.\n\n' + f'Ников: <b>{len(nicks)}</b>\n' + f'Страница: <b>{page + 1}/{total_pages}</b>'
 
 def _blacklist_nicks_kb(chat_id: int, page: int=0) -> InlineKeyboardMarkup:
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     nicks = list(cfg.get('blacklist_nicks') or [])
     page, total_pages = _clamp_blacklist_nick_page(len(nicks), page)
     start = page * BLACKLIST_NICKS_PAGE_SIZE
@@ -1421,8 +2340,7 @@ def open_blacklist_nicks(cardinal: 'Cardinal', call, page: int=0, notice: str=''
     bot = cardinal.telegram.bot
     _answer_cbq(bot, call)
     chat_id = call.message.chat.id
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     page, _ = _clamp_blacklist_nick_page(len(cfg.get('blacklist_nicks') or []), page)
     _safe_edit(bot, chat_id, _mid(call.message), _blacklist_nicks_text(chat_id, page, notice), _blacklist_nicks_kb(chat_id, page))
 
@@ -1460,20 +2378,18 @@ def start_blacklist_text_edit(cardinal: 'Cardinal', call):
     _answer_cbq(bot, call)
     chat_id = call.message.chat.id
     msg_id = _mid(call.message)
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     tpl = str(cfg.get('blacklist_text') or _default_cfg()['blacklist_text'])
     _fsm[chat_id] = {'mode': 'blacklist_text', 'panel_chat_id': chat_id, 'panel_msg_id': msg_id, 'return': CB_BL}
     _safe_edit(bot, chat_id, msg_id, f'💬 <b>Текст ответа для чёрного списка</b>\n\nТекущий текст:\n<code>{escape(tpl)}</code>\n\nПлейсхолдеры:\n• <code>{{nick}}</code> — ник покупателя\n• <code>{{buyer_id}}</code> — ID покупателя/чата\n• <code>{{matched_nick}}</code> — ник из ЧС, который совпал\n• <code>{{name}}</code> — название SDA аккаунта\n• <code>{{command}}</code> — команда аккаунта\n\nОтправь новый текст одним сообщением.\nЧтобы вернуть стандартный текст — отправь <code>-</code>.\n', _cancel_kb(CB_BL))
 
 def _blacklist_accounts_text(chat_id: int) -> str:
-    data = load_data()
-    cfg = _get_cfg(data)
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    data = _data_view()
+    cfg = _read_cfg(data)
+    accounts = _view_accounts_for(chat_id, data)
     if not accounts:
         return '✅ <b>Аккаунты для чёрного списка</b>\n\n❌ SDA аккаунтов нет.'
-    selected = set((str(x) for x in cfg.get('blacklist_account_ids') or []))
+    selected = cfg.blacklist_account_ids
     lines = []
     for i, acc in enumerate(accounts, start=1):
         acc_id = str(acc.get('account_id') or '')
@@ -1484,11 +2400,10 @@ def _blacklist_accounts_text(chat_id: int) -> str:
     return '✅ <b>Аккаунты для чёрного списка</b>\n\nОтмеченные аккаунты будут проверяться, если режим применения = <b>выбранные аккаунты</b>.\n\n' + '\n\n'.join(lines)
 
 def _blacklist_accounts_kb(chat_id: int) -> InlineKeyboardMarkup:
-    data = load_data()
-    cfg = _get_cfg(data)
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
-    selected = set((str(x) for x in cfg.get('blacklist_account_ids') or []))
+    data = _data_view()
+    cfg = _read_cfg(data)
+    accounts = _view_accounts_for(chat_id, data)
+    selected = cfg.blacklist_account_ids
     kb = InlineKeyboardMarkup()
     for idx, acc in enumerate(accounts):
         acc_id = str(acc.get('account_id') or '')
@@ -1535,22 +2450,35 @@ def toggle_blacklist_account(cardinal: 'Cardinal', call, account_id: str):
     _safe_edit(bot, chat_id, msg_id, _blacklist_accounts_text(chat_id), _blacklist_accounts_kb(chat_id))
 
 def _cancel_all_queue_timers():
-    with _timer_lock:
+    with _queue_stripes, _timer_lock:
         keys = list(_queue_timers.keys())
     for key in keys:
         _cancel_timer(key)
 
 def _find_live_account_by_key(account_key: str):
-    data = load_data()
-    cfg = _get_cfg(data)
-    for owner_uid, accounts in (data or {}).items():
-        if owner_uid == 'global' or not isinstance(accounts, list):
+    data = _data_view()
+    cfg = _read_cfg(data)
+    owner_uid, acc = _account_key_index(data).get(account_key) or (None, None)
+    return (owner_uid, acc, cfg)
+
+def _find_slot_entry(slot_key: str, item: Mapping):
+    data = _data_view()
+    cfg = _read_cfg(data)
+    owner_uid, account_id, cmd = (str(item.get('owner_uid') or ''), str(item.get('account_id') or ''), str(item.get('command') or ''))
+    fallback = (None, None)
+    for entry_owner, acc in _slot_index(data).get(slot_key) or ():
+        if entry_owner != owner_uid:
             continue
-        _ensure_account_ids(str(owner_uid), accounts)
-        for acc in accounts:
-            if isinstance(acc, dict) and _account_key(str(owner_uid), acc) == account_key:
-                return (str(owner_uid), acc, cfg)
-    return (None, None, cfg)
+        if account_id and str(acc.get('account_id') or '') == account_id:
+            return (entry_owner, acc, cfg)
+        if fallback[1] is None and _normalize_cmd(str(acc.get('command') or '')) == cmd:
+            fallback = (entry_owner, acc)
+    return (*fallback, cfg)
+
+def _slot_queue_effective(slot_key: str) -> bool:
+    data = _data_view()
+    cfg = _read_cfg(data)
+    return any((_account_queue_effective(acc, cfg) for _, acc in _slot_index(data).get(slot_key) or ()))
 
 def _account_queue_effective(acc: dict, cfg: dict) -> bool:
     return bool(cfg.get('plugin_enabled', True)) and bool(cfg.get('queue_enabled', True)) and bool(acc.get('enabled', True)) and bool(acc.get('queue_enabled', True))
@@ -1561,15 +2489,14 @@ def _account_command_notifications_effective(acc: dict, cfg: dict) -> bool:
 def _reschedule_available_queues(cardinal: 'Cardinal'):
     if not _plugin_enabled() or not _queue_enabled():
         return
-    q = load_queue()
-    _cleanup_queue_state(q)
-    save_queue(q)
-    for account_key, st in q.items():
-        if not isinstance(st, dict) or not st.get('queue'):
-            continue
-        _, acc, cfg = _find_live_account_by_key(account_key)
-        if acc is not None and _account_queue_effective(acc, cfg):
-            _schedule_queue_processing(cardinal, account_key, _seconds_to_next_slot())
+    with _queue_stripes:
+        q = load_queue()
+        _cleanup_queue_state(q)
+        save_queue(q)
+        pending = [slot_key for slot_key, st in q.items() if isinstance(st, dict) and st.get('queue')]
+    for slot_key in pending:
+        if _slot_queue_effective(slot_key):
+            _schedule_queue_processing(cardinal, slot_key, _seconds_to_next_slot())
 
 def toggle_plugin(cardinal: 'Cardinal', call):
     bot = cardinal.telegram.bot
@@ -1627,18 +2554,14 @@ def _clamp_account_page(total: int, page: int, per_page: int=ACCOUNT_LIST_PAGE_S
     return (page, total_pages)
 
 def _list_text(chat_id: int, page: int=0) -> str:
-    data = load_data()
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    accounts = _view_accounts_for(chat_id)
     if not accounts:
         return '📜 <b>Список аккаунтов.</b>\n\nНажмите на аккаунт, если хотите его посмотреть или редактировать.\n\n❌ Аккаунтов пока нет.'
     page, total_pages = _clamp_account_page(len(accounts), page)
     return f'📜 <b>Список аккаунтов.</b>\n\nНажмите на аккаунт, если хотите его посмотреть или редактировать.\n\nАккаунтов: <b>{len(accounts)}</b>\nСтраница: <b>{page + 1}/{total_pages}</b>'
 
 def _list_kb(chat_id: int, page: int=0) -> InlineKeyboardMarkup:
-    data = load_data()
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    accounts = _view_accounts_for(chat_id)
     page, total_pages = _clamp_account_page(len(accounts), page)
     start = page * ACCOUNT_LIST_PAGE_SIZE
     chunk = accounts[start:start + ACCOUNT_LIST_PAGE_SIZE]
@@ -1675,9 +2598,7 @@ def open_list(cardinal: 'Cardinal', call, page: int=0):
     _answer_cbq(bot, call)
     chat_id = call.message.chat.id
     msg_id = _mid(call.message)
-    data = load_data()
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    accounts = _view_accounts_for(chat_id)
     page, _ = _clamp_account_page(len(accounts), page)
     _safe_edit(bot, chat_id, msg_id, _list_text(chat_id, page), _list_kb(chat_id, page))
 
@@ -1700,7 +2621,6 @@ def _get_account_context(chat_id: int, account_id: str):
     cfg = _get_cfg(data)
     accounts = _get_accounts_for(chat_id, data)
     idx = _find_account_index(accounts, account_id)
-    save_data(data)
     return (data, cfg, accounts, idx)
 
 def _account_detail_text(chat_id: int, account_id: str, notice: str='') -> str:
@@ -1720,7 +2640,7 @@ def _account_detail_text(chat_id: int, account_id: str, notice: str='') -> str:
     account_notify_state = 'ВКЛ' if bool(acc.get('command_notifications_enabled', True)) else 'ВЫКЛ'
     effective_notify_state = 'ВКЛ' if _account_command_notifications_effective(acc, cfg) else 'ВЫКЛ'
     prefix = f'{notice}\n\n' if notice else ''
-    return prefix + '👤 <b>Аккаунт Steam Guard</b>\n\n' + f'🏷 Название: <b>{escape(name)}</b>\n' + f'⚡ Выдача кодов: <b>{enabled_state}</b>\n' + f'⏳ Очередь аккаунта: <b>{account_queue_state}</b> (фактически: <b>{effective_queue_state}</b>)\n' + f'🔔 Уведомления команд: <b>{account_notify_state}</b> (фактически: <b>{effective_notify_state}</b>)\n' + f"💬 Команда: <code>{escape(command or '—')}</code>\n" + f'🔢 Лимит: <code>{escape(_limit_text(acc))}</code>\n' + f'📝 Тип текста: <b>{escape(template_type)}</b>\n' + f"🔐 shared_secret: <code>{escape(_mask_secret(str(acc.get('shared_secret') or '')))}</code>\n\n" + '📨 <b>Текущий текст ответа:</b>\n' + f"<code>{escape(preview or '—')}</code>\n\n" + 'Выберите, что хотите изменить:'
+    return prefix + '👤 <b>Аккаунт Steam Guard</b>\n\n' + f'🏷 Название: <b>{escape(name)}</b>\n' + f'⚡ Выдача кодов: <b>{enabled_state}</b>\n' + f'⏳ Очередь аккаунта: <b>{account_queue_state}</b> (фактически: <b>{effective_queue_state}</b>)\n' + f'🔔 Уведомления команд: <b>{account_notify_state}</b> (фактически: <b>{effective_notify_state}</b>)\n' + f"💬 Команда: <code>{escape(command or '—')}</code>\n" + f'🔢 Лимит: <code>{escape(_limit_text(acc))}</code>\n' + f'👥 Покупателей за окно 30с: <b>{_account_slots(acc)}</b>\n' + f'📝 Тип текста: <b>{escape(template_type)}</b>\n' + f"🔐 shared_secret: <code>{escape(_mask_secret(str(acc.get('shared_secret') or '')))}</code>\n\n" + '📨 <b>Текущий текст ответа:</b>\n' + f"<code>{escape(preview or '—')}</code>\n\n" + 'Выберите, что хотите изменить:'
 
 def _account_edit_cancel_kb() -> InlineKeyboardMarkup:
     kb = InlineKeyboardMarkup()
@@ -1745,6 +2665,7 @@ def _account_detail_kb(account_id: str, page: int, chat_id: Optional[int]=None)
     kb.row(InlineKeyboardButton('📝 Общий / кастомный текст', callback_data=f'{CB_ACCOUNT_TEXT_MENU}:{account_id}:{page}'))
     kb.row(InlineKeyboardButton('🔐 Заменить secret / maFile', callback_data=f'{CB_ACCOUNT_EDIT_SECRET}:{account_id}:{page}'))
     kb.row(InlineKeyboardButton('🔢 Изменить лимит', callback_data=f'{CB_ACCOUNT_EDIT_LIMIT}:{account_id}:{page}'))
+    kb.row(InlineKeyboardButton('👥 Покупателей за окно', callback_data=f'{CB_ACCOUNT_EDIT_SLOTS}:{account_id}:{page}'))
     kb.row(InlineKeyboardButton('◀️ К списку аккаунтов', callback_data=f'{CB_LIST_PAGE}:{page}'))
     return kb
 
@@ -1762,19 +2683,16 @@ def open_account_detail(cardinal: 'Cardinal', call):
     _show_account_detail_panel(bot, call.message.chat.id, _mid(call.message), account_id, page)
 
 def _clear_account_pending_queue(owner_uid: str, acc: dict) -> int:
-    account_key = _account_key(str(owner_uid), acc)
+    slot_key = _slot_key(acc)
     removed = 0
-    with _queue_lock:
+    with _queue_stripes(slot_key):
         q = load_queue()
-        st = q.get(account_key)
+        st = q.get(slot_key)
         if isinstance(st, dict):
-            queue_arr = st.get('queue')
-            if isinstance(queue_arr, list):
-                removed = len(queue_arr)
-            st['queue'] = []
-            q[account_key] = st
-            save_queue(q)
-    _cancel_timer(account_key)
+            removed = _remove_queue_items(st, _account_item_matcher(owner_uid, acc))
+            save_queue(q, [slot_key])
+            if not st['queue']:
+                _cancel_timer(slot_key)
     return removed
 
 def toggle_account_enabled(cardinal: 'Cardinal', call):
@@ -1869,12 +2787,14 @@ def open_account_text_menu(cardinal: 'Cardinal', call):
 
 def _drop_account_queue(owner_uid: str, old_acc: dict):
     try:
-        key = _account_key(str(owner_uid), old_acc)
-        q = load_queue()
-        if key in q:
-            q.pop(key, None)
-            save_queue(q)
-        _cancel_timer(key)
+        key = _slot_key(old_acc)
+        with _queue_stripes(key):
+            q = load_queue()
+            st = q.get(key)
+            if isinstance(st, dict) and _remove_queue_items(st, _account_item_matcher(owner_uid, old_acc)):
+                save_queue(q, [key])
+            if not isinstance(st, dict) or not st['queue']:
+                _cancel_timer(key)
     except Exception as e:
         logger.warning(f'{PREFIX} account queue cleanup failed: {e}')
 
@@ -1953,6 +2873,19 @@ def start_account_limit_edit(cardinal: 'Cardinal', call):
     _fsm[chat_id] = {'mode': 'account_edit', 'step': 'limit', 'account_id': account_id, 'page': page, 'panel_chat_id': chat_id, 'panel_msg_id': msg_id, 'return': 'account_detail'}
     _safe_edit(bot, chat_id, msg_id, f'🔢 <b>Изменение лимита</b>\n\nТекущий лимит: <code>{escape(_limit_text(accounts[idx]))}</code>\n\nОтправьте:\n• число больше 0 — новый лимит;\n• <code>-</code> — без ограничений.\n\n', _account_edit_cancel_kb())
 
+def start_account_slots_edit(cardinal: 'Cardinal', call):
+    bot = cardinal.telegram.bot
+    _answer_cbq(bot, call)
+    account_id, page = _parse_account_callback(call.data, CB_ACCOUNT_EDIT_SLOTS)
+    chat_id = call.message.chat.id
+    msg_id = _mid(call.message)
+    _, _, accounts, idx = _get_account_context(chat_id, account_id)
+    if idx < 0:
+        _show_account_detail_panel(bot, chat_id, msg_id, account_id, page)
+        return
+    _fsm[chat_id] = {'mode': 'account_edit', 'step': 'slots', 'account_id': account_id, 'page': page, 'panel_chat_id': chat_id, 'panel_msg_id': msg_id, 'return': 'account_detail'}
+    _safe_edit(bot, chat_id, msg_id, f'👥 <b>Покупателей за окно</b>\n\nСейчас: <b>{_account_slots(accounts[idx])}</b>.\n\nСколько покупателей могут получить один и тот же код за 30 секунд. Больше 1 ставьте только для аккаунтов с общим доступом.\n\nОтправьте число от 1 до {ACCOUNT_MAX_SLOTS}.', _account_edit_cancel_kb())
+
 def _account_edit_context(chat_id: int, st: dict):
     account_id = str(st.get('account_id') or '')
     data = load_data()
@@ -2079,20 +3012,28 @@ def _handle_account_edit_text(text: str, cardinal: 'Cardinal', chat_id: int, pan
         label = f'{limit} навсегда' if hours is None else f'{limit} за {hours}ч'
         _finish_account_edit(bot, chat_id, panel_msg_id, account_id, page, f'✅ Лимит изменён: <code>{escape(label)}</code>.')
         return
+    if step == 'slots':
+        try:
+            slots = int(text.strip())
+            if not 1 <= slots <= ACCOUNT_MAX_SLOTS:
+                raise ValueError
+        except ValueError:
+            _safe_edit(bot, chat_id, panel_msg_id, f'❌ Введите число от 1 до {ACCOUNT_MAX_SLOTS}.', _account_edit_cancel_kb())
+            return
+        accounts[idx]['slots_per_window'] = slots
+        _save_account_record(chat_id, data, accounts, idx, old_acc)
+        _finish_account_edit(bot, chat_id, panel_msg_id, account_id, page, f'✅ Покупателей за окно: <b>{slots}</b>.')
+        return
     _finish_account_edit(bot, chat_id, panel_msg_id, account_id, page, '⚠️ Неизвестный этап редактирования.')
 
 def _del_menu_text(chat_id: int) -> str:
-    data = load_data()
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    accounts = _view_accounts_for(chat_id)
     if not accounts:
         return '🗑 <b>Удалить аккаунт</b>\n\n❌ Аккаунтов нет.'
     return '🗑 <b>Удалить аккаунт</b>\n\nВыбери аккаунт для удаления:'
 
 def _del_menu_kb(chat_id: int) -> InlineKeyboardMarkup:
-    data = load_data()
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    accounts = _view_accounts_for(chat_id)
     kb = InlineKeyboardMarkup()
     for idx, acc in enumerate(accounts):
         title = str(acc.get('name') or f'Аккаунт {idx + 1}')
@@ -2122,9 +3063,7 @@ def open_del_confirm(cardinal: 'Cardinal', call, idx: int):
     _answer_cbq(bot, call)
     chat_id = call.message.chat.id
     msg_id = _mid(call.message)
-    data = load_data()
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    accounts = _view_accounts_for(chat_id)
     if idx < 0 or idx >= len(accounts):
         _safe_edit(bot, chat_id, msg_id, '❌ Аккаунт не найден.', _back_to_settings_kb())
         return
@@ -2152,15 +3091,9 @@ def del_no(cardinal: 'Cardinal', call):
     open_del_menu(cardinal, call)
 
 def _logs_text(chat_id: int, page: int=0, per_page: int=8) -> str:
-    owner_uid = str(chat_id)
-    logs = load_logs()
-    arr = logs.get(owner_uid)
-    if not isinstance(arr, list) or not arr:
+    total, page, total_pages, chunk = _read_log_page(str(chat_id), page, per_page)
+    if not total:
         return '🧾 <b>Диагностические логи</b>\n\n❌ Пока пусто.'
-    arr = list(reversed(arr))
-    total_pages = max(1, (len(arr) + per_page - 1) // per_page)
-    page = max(0, min(int(page), total_pages - 1))
-    chunk = arr[page * per_page:(page + 1) * per_page]
     icons = {'START': '🚀', 'STOP': '🛑', 'UI_CLICK': '👆', 'SCREEN': '🧭', 'COMMAND': '💬', 'CODE': '✅', 'QUEUE': '⏳', 'LIMIT': '🔢', 'BUSY': '⌛', 'BLACKLIST': '🚫', 'CONFIG': '📦', 'ERROR': '❌', 'DISABLED': '⛔', 'FSM_INPUT': '⌨️', 'ACTION': '⚙️', 'INFO': 'ℹ️'}
     lines = []
     for e in chunk:
@@ -2177,12 +3110,10 @@ def _logs_text(chat_id: int, page: int=0, per_page: int=8) -> str:
         if details:
             block += '\n' + ' | '.join(details)
         lines.append(block)
-    return f'🧾 <b>Диагностические логи</b>\n\nВсего событий: <b>{len(arr)}</b> | Версия: <code>{escape(VERSION)}</code>\nСтраница: <b>{page + 1}/{total_pages}</b>\n\n' + '\n\n'.join(lines)
+    return f'🧾 <b>Диагностические логи</b>\n\nВсего событий: <b>{total}</b> | Версия: <code>{escape(VERSION)}</code>\n{_send_stats_text()}\n{_steam_time_text()}\nСтраница: <b>{page + 1}/{total_pages}</b>\n\n' + '\n\n'.join(lines)
 
 def _logs_kb(chat_id: int, page: int, per_page: int=8) -> InlineKeyboardMarkup:
-    logs = load_logs()
-    arr = logs.get(str(chat_id))
-    total = len(arr) if isinstance(arr, list) else 0
+    total = _log_count(chat_id)
     total_pages = max(1, (total + per_page - 1) // per_page)
     page = max(0, min(int(page), total_pages - 1))
     kb = InlineKeyboardMarkup()
@@ -2205,8 +3136,7 @@ def open_logs(cardinal: 'Cardinal', call, page: int):
     _safe_edit(bot, chat_id, msg_id, _logs_text(chat_id, page), _logs_kb(chat_id, page))
 
 def _template_text(chat_id: int) -> str:
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     tpl = (cfg.get('template') or '').strip()
     return f"✏️ <b>Общее сообщение выдачи кода</b>\n\nТекущий общий шаблон:\n<code>{escape(tpl or '—')}</code>\n\nПлейсхолдеры:\n• <code>{{code}}</code> — код\n• <code>{{name}}</code> — название аккаунта\n• <code>{{command}}</code> — команда\n• <code>{{left}}</code> — осталось\n• <code>{{total}}</code> — всего/∞\n• <code>{{limit_text}}</code> — лимит текстом\n\nОтправь новый общий шаблон <b>одним сообщением</b>.\n"
 
@@ -2219,10 +3149,9 @@ def start_template_edit(cardinal: 'Cardinal', call):
     _safe_edit(bot, chat_id, msg_id, _template_text(chat_id), _cancel_kb(CB_SETTINGS))
 
 def _account_template_menu_text(chat_id: int) -> str:
-    data = load_data()
-    cfg = _get_cfg(data)
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    data = _data_view()
+    cfg = _read_cfg(data)
+    accounts = _view_accounts_for(chat_id, data)
     if not accounts:
         return '🧩 <b>Кастомные тексты аккаунтов</b>\n\n❌ Аккаунтов нет.'
     mode_label = _template_mode_label(str(cfg.get('template_mode') or 'global'))
@@ -2235,9 +3164,7 @@ def _account_template_menu_text(chat_id: int) -> str:
     return f'🧩 <b>Кастомные тексты аккаунтов</b>\n\nТекущий режим: <b>{escape(mode_label)}</b>\nКастомные тексты реально используются только когда режим текста = <b>Кастомный</b>.\n\nВыбери аккаунт, для которого нужно настроить отдельный текст выдачи кода.\n\n' + '\n\n'.join(lines)
 
 def _account_template_menu_kb(chat_id: int) -> InlineKeyboardMarkup:
-    data = load_data()
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    accounts = _view_accounts_for(chat_id)
     kb = InlineKeyboardMarkup()
     for idx, acc in enumerate(accounts):
         name = str(acc.get('name') or f'Аккаунт {idx + 1}')
@@ -2256,10 +3183,9 @@ def open_account_template_menu(cardinal: 'Cardinal', call):
     _safe_edit(bot, chat_id, msg_id, _account_template_menu_text(chat_id), _account_template_menu_kb(chat_id))
 
 def _account_template_edit_text(chat_id: int, account_id: str) -> str:
-    data = load_data()
-    cfg = _get_cfg(data)
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    data = _data_view()
+    cfg = _read_cfg(data)
+    accounts = _view_accounts_for(chat_id, data)
     idx = _find_account_index(accounts, account_id)
     if idx < 0:
         return '❌ Аккаунт не найден. Вернись назад и выбери аккаунт заново.'
@@ -2283,9 +3209,7 @@ def start_account_template_edit(cardinal: 'Cardinal', call, account_id: str):
     _answer_cbq(bot, call)
     chat_id = call.message.chat.id
     msg_id = _mid(call.message)
-    data = load_data()
-    accounts = _get_accounts_for(chat_id, data)
-    save_data(data)
+    accounts = _view_accounts_for(chat_id)
     idx = _find_account_index(accounts, account_id)
     if idx < 0:
         try:
@@ -2388,8 +3312,7 @@ def _add_choose_custom_command(cardinal: 'Cardinal', call):
     _safe_edit(bot, chat_id, panel_msg_id, '✏️ <b>Своя команда</b>\n\nОтправь команду одним сообщением.\nРекомендуемый формат: <code>!code_ник</code>\nПример: <code>!code_tinechelovec</code>\n\n⚠️ Команда будет очищена от пробелов и невидимых символов.', _cancel_kb(CB_SETTINGS))
 
 def _show_add_template_choice(bot, chat_id: int, panel_msg_id: int, st: dict):
-    data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg()
     global_tpl = str(cfg.get('template') or _default_cfg()['template']).strip()
     preview = global_tpl if len(global_tpl) <= 350 else global_tpl[:347] + '…'
     st['step'] = 'template_choice'
@@ -2803,37 +3726,109 @@ def _mask_sensitive_debug_text(text: str) -> str:
     text = re.sub('(код\\s*[:：]\\s*)[A-Z0-9]{5}', '\\1*****', text, flags=re.I)
     return text
 
+def _filter_guard_active() -> bool:
+    return getattr(_filter_guard, 'depth', 0) > 0
+
+def _filter_guard_enter():
+    _filter_guard.depth = getattr(_filter_guard, 'depth', 0) + 1
+
+def _filter_guard_exit():
+    _filter_guard.depth = max(0, getattr(_filter_guard, 'depth', 0) - 1)
+
 def _notify_debug(action: str, **fields):
+    _filter_guard_enter()
     try:
-        data = load_data()
-        cfg = _get_cfg(data)
+        _enqueue_notify_debug(action, fields)
+    finally:
+        _filter_guard_exit()
+
+def _enqueue_notify_debug(action: str, fields: dict):
+    global _notify_debug_dropped
+    try:
+        cfg = _read_cfg()
         if not bool(cfg.get('command_notifications_debug_enabled', True)):
             return
     except Exception:
         pass
+    _start_notify_debug_writer()
     try:
+        _notify_debug_queue.put_nowait((int(time.time()), str(action), dict(fields or {})))
+    except Full:
+        with _notify_debug_lock:
+            _notify_debug_dropped += 1
+
+def _start_notify_debug_writer():
+    global _notify_debug_writer_started
+    if _notify_debug_writer_started:
+        return
+    with _notify_debug_lock:
+        if _notify_debug_writer_started:
+            return
+        _notify_debug_writer_started = True
+    threading.Thread(target=_notify_debug_writer_worker, name='SDA-DEBUG-LOG', daemon=True).start()
+
+def _notify_debug_writer_worker():
+    _filter_guard_enter()
+    while True:
+        try:
+            batch = [_notify_debug_queue.get(timeout=NOTIFY_DEBUG_FLUSH_INTERVAL)]
+        except Empty:
+            if _notify_debug_dropped:
+                try:
+                    _write_notify_debug_batch([])
+                except Exception:
+                    pass
+            continue
+        while len(batch) < NOTIFY_DEBUG_BATCH_SIZE:
+            try:
+                batch.append(_notify_debug_queue.get_nowait())
+            except Empty:
+                break
+        try:
+            _write_notify_debug_batch(batch)
+        except Exception:
+            pass
+
+def _write_notify_debug_batch(batch: List[tuple]):
+    global _notify_debug_dropped
+    lines = []
+    summaries = []
+    for ts, action, fields in batch:
         safe_fields = {}
-        for k, v in (fields or {}).items():
+        for k, v in fields.items():
             if isinstance(v, str):
                 safe_fields[k] = _mask_sensitive_debug_text(v)
             else:
                 safe_fields[k] = v
-        rec = {'ts': int(time.time()), 'dt': datetime.fromtimestamp(int(time.time())).strftime('%d.%m.%Y %H:%M:%S'), 'action': str(action), **safe_fields}
-        line = json.dumps(rec, ensure_ascii=False, default=str)
-        with _notify_debug_lock:
+        rec = {'ts': ts, 'dt': datetime.fromtimestamp(ts).strftime('%d.%m.%Y %H:%M:%S'), 'action': action, **safe_fields}
+        try:
+            lines.append(json.dumps(rec, ensure_ascii=False, default=str))
+        except Exception:
+            continue
+        summary = ', '.join((f'{k}={_debug_preview(str(v), 140)}' for k, v in list(safe_fields.items())[:6]))
+        summaries.append(f'{PREFIX} [notify-debug] {action}' + (f': {summary}' if summary else ''))
+    with _notify_debug_lock:
+        dropped, _notify_debug_dropped = (_notify_debug_dropped, 0)
+        if dropped:
+            ts = int(time.time())
+            lines.append(json.dumps({'ts': ts, 'dt': datetime.fromtimestamp(ts).strftime('%d.%m.%Y %H:%M:%S'), 'action': 'notify_debug_dropped', 'count': dropped}, ensure_ascii=False))
+        if lines:
             os.makedirs(PLUGIN_FOLDER, exist_ok=True)
             with open(NOTIFY_DEBUG_FILE, 'a', encoding='utf-8') as f:
-                f.write(line + '\n')
-            try:
-                if os.path.getsize(NOTIFY_DEBUG_FILE) > 700000:
-                    with open(NOTIFY_DEBUG_FILE, 'r', encoding='utf-8') as f:
-                        lines = f.readlines()[-900:]
-                    with open(NOTIFY_DEBUG_FILE, 'w', encoding='utf-8') as f:
-                        f.writelines(lines)
-            except Exception:
-                pass
-        summary = ', '.join((f'{k}={_debug_preview(str(v), 140)}' for k, v in list(safe_fields.items())[:6]))
-        logger.info(f'{PREFIX} [notify-debug] {action}' + (f': {summary}' if summary else ''))
+                f.write('\n'.join(lines) + '\n')
+                size = f.tell()
+            if size > NOTIFY_DEBUG_SEGMENT_SIZE:
+                _rotate_notify_debug_segments()
+    for summary in summaries:
+        logger.info(summary)
+
+def _rotate_notify_debug_segments():
+    try:
+        for idx in range(NOTIFY_DEBUG_SEGMENTS - 1, 1, -1):
+            src = f'{NOTIFY_DEBUG_FILE}.{idx - 1}'
+            if os.path.exists(src):
+                os.replace(src, f'{NOTIFY_DEBUG_FILE}.{idx}')
+        os.replace(NOTIFY_DEBUG_FILE, f'{NOTIFY_DEBUG_FILE}.1')
     except Exception:
         pass
 
@@ -2876,19 +3871,19 @@ def _candidate_message_texts_from_notification(text: str) -> List[str]:
         result.append(item)
     return result
 
-def _notification_text_has_exact_command_line(text: str, data: Optional[dict]=None) -> bool:
+def _notification_text_has_exact_command_line(text: str, data: Optional[Mapping]=None) -> bool:
     if data is None:
-        data = load_data()
+        data = _data_view()
     for candidate in _candidate_message_texts_from_notification(text):
         candidate = re.sub('^[>\\-—→\\s]+', '', str(candidate or '')).strip()
         if _is_exact_plugin_command(candidate, data):
             return True
     return False
 
-def _should_suppress_any_notification_text(text: str, data: Optional[dict]=None, source: str='') -> bool:
+def _should_suppress_any_notification_text(text: str, data: Optional[Mapping]=None, source: str='') -> bool:
     if data is None:
-        data = load_data()
-    cfg = _get_cfg(data)
+        data = _data_view()
+    cfg = _read_cfg(data)
     if not bool(cfg.get('plugin_enabled', True)):
         return False
     text = str(text or '')
@@ -2920,8 +3915,7 @@ def _patch_telegram_bot_send_message(cardinal: 'Cardinal') -> bool:
 
     def wrapped_bot_send_message(chat_id, text, *args, _original=original, **kwargs):
         try:
-            data = load_data()
-            if _should_suppress_any_notification_text(str(text or ''), data, source='telegram.bot.send_message'):
+            if _should_suppress_any_notification_text(str(text or ''), None, source='telegram.bot.send_message'):
                 _notify_debug('bot_send_message_suppressed', chat_id=str(chat_id), preview=_debug_preview(str(text or '')))
                 return None
         except Exception:
@@ -2939,6 +3933,30 @@ def _patch_telegram_bot_send_message(cardinal: 'Cardinal') -> bool:
         _notify_debug('patch_bot_send_message_failed', error=str(e), bot_type=str(type(bot)))
         return False
 
+def _console_logger_in_scope(name: str) -> bool:
+    scoped = _console_logger_scope.get(name)
+    if scoped is None:
+        if name == logger.name or name.startswith(logger.name + '.'):
+            scoped = False
+        elif '*' in CONSOLE_FILTER_LOGGERS:
+            scoped = True
+        else:
+            scoped = any((name == x or name.startswith(x + '.') for x in CONSOLE_FILTER_LOGGERS))
+        _console_logger_scope[name] = scoped
+    return scoped
+
+def _console_text_may_be_notification(text: str) -> bool:
+    if '<' in text or '&' in text or _CONSOLE_HINT_RE.search(text):
+        return True
+    pf = _snapshot_derived('command_prefilter', _build_command_prefilter)
+    if not pf['commands']:
+        return False
+    if not pf['ascii_first']:
+        return True
+    probe = text if text.isascii() else unicodedata.normalize('NFKC', text)
+    probe = probe.lower()
+    return any((ch in probe for ch in pf['first_chars']))
+
 def _patch_console_logger_filter() -> bool:
     global _original_logger_log
     with _logger_filter_lock:
@@ -2947,18 +3965,24 @@ def _patch_console_logger_filter() -> bool:
             return True
 
         def wrapped_logger_log(self, level, msg, args, exc_info=None, extra=None, stack_info=False, stacklevel=1):
+            if _filter_guard_active():
+                return original(self, level, msg, args, exc_info=exc_info, extra=extra, stack_info=stack_info, stacklevel=stacklevel)
+            _filter_guard_enter()
             try:
-                rendered = str(msg)
-                if args:
-                    try:
-                        rendered = rendered % args
-                    except Exception:
-                        rendered = str(msg)
-                if _should_suppress_any_notification_text(rendered, None, source=f"logging.{getattr(self, 'name', '')}"):
-                    _notify_debug('console_log_suppressed', logger_name=str(getattr(self, 'name', '')), level=int(level), preview=_debug_preview(rendered))
-                    return None
+                if level <= CONSOLE_FILTER_MAX_LEVEL and _console_logger_in_scope(getattr(self, 'name', '')):
+                    rendered = str(msg)
+                    if args:
+                        try:
+                            rendered = rendered % args
+                        except Exception:
+                            rendered = str(msg)
+                    if _console_text_may_be_notification(rendered) and _should_suppress_any_notification_text(rendered, None, source=f"logging.{getattr(self, 'name', '')}"):
+                        _notify_debug('console_log_suppressed', logger_name=str(getattr(self, 'name', '')), level=int(level), preview=_debug_preview(rendered))
+                        return None
             except Exception:
                 pass
+            finally:
+                _filter_guard_exit()
             return original(self, level, msg, args, exc_info=exc_info, extra=extra, stack_info=stack_info, stacklevel=stacklevel)
         wrapped_logger_log._steam_guard_sda_wrapped = True
         wrapped_logger_log._steam_guard_sda_original = original
@@ -3038,47 +4062,26 @@ def _is_own_or_bot_message(msg, cardinal: Optional['Cardinal']=None) -> bool:
         pass
     return False
 
-def _is_exact_plugin_command(raw_text: str, data: Optional[dict]=None) -> bool:
-    text = _normalize_cmd(raw_text)
+def _is_exact_plugin_command(raw_text: str, data: Optional[Mapping]=None) -> bool:
+    if data is None:
+        data = _data_view()
+    text = _match_command_text(raw_text, data)
     if not text:
         return False
-    if data is None:
-        data = load_data()
-    cfg = _get_cfg(data)
+    cfg = _read_cfg(data)
     if not bool(cfg.get('plugin_enabled', True)):
         return False
-    matched = []
-    for owner_uid, accounts in (data or {}).items():
-        if owner_uid == 'global' or not isinstance(accounts, list):
-            continue
-        for acc in accounts:
-            if not isinstance(acc, dict):
-                continue
-            cmd = _normalize_cmd(str(acc.get('command', '') or ''))
-            if cmd and text == cmd:
-                matched.append(acc)
+    matched = [acc for _, acc in _command_index(data).get(text, ())]
     if not matched:
         return False
     return all((not _account_command_notifications_effective(acc, cfg) for acc in matched))
 
-def _get_plugin_commands(data: Optional[dict]=None) -> set:
-    if data is None:
-        data = load_data()
-    commands = set()
-    for owner_uid, accounts in (data or {}).items():
-        if owner_uid == 'global' or not isinstance(accounts, list):
-            continue
-        for acc in accounts:
-            if not isinstance(acc, dict):
-                continue
-            cmd = _normalize_cmd(str(acc.get('command', '') or ''))
-            if cmd:
-                commands.add(cmd)
-    return commands
+def _get_plugin_commands(data: Optional[Mapping]=None) -> set:
+    return set(_command_index(data))
 
 def _should_skip_command_message_notification(event: NewMessageEvent, cardinal: Optional['Cardinal']=None) -> bool:
-    data = load_data()
-    cfg = _get_cfg(data)
+    data = _data_view()
+    cfg = _read_cfg(data)
     if not bool(cfg.get('plugin_enabled', True)):
         return False
     buyer_messages = []
@@ -3149,16 +4152,16 @@ def _block_is_own_or_bot(block: str) -> bool:
     author = _block_author_plain(block)
     return 'вы' in author or 'бот' in author
 
-def _block_is_exact_command(block: str, data: Optional[dict]=None) -> bool:
+def _block_is_exact_command(block: str, data: Optional[Mapping]=None) -> bool:
     codes = _block_code_values(block)
     if not codes:
         plain = _html_to_plain(block)
         return _is_exact_plugin_command(plain, data)
     return any((_is_exact_plugin_command(code, data) for code in codes))
 
-def _should_suppress_new_message_text(text: str, data: Optional[dict]=None) -> bool:
+def _should_suppress_new_message_text(text: str, data: Optional[Mapping]=None) -> bool:
     if data is None:
-        data = load_data()
+        data = _data_view()
     blocks = _split_notification_blocks(text)
     user_blocks = [b for b in blocks if not _block_is_own_or_bot(b)]
     if not user_blocks:
@@ -3167,9 +4170,9 @@ def _should_suppress_new_message_text(text: str, data: Optional[dict]=None) -> b
     user_has_other_text = any((not _block_is_exact_command(b, data) for b in user_blocks))
     return user_has_exact_command and (not user_has_other_text)
 
-def _strip_exact_command_blocks_from_notification_text(text: str, data: Optional[dict]=None) -> str:
+def _strip_exact_command_blocks_from_notification_text(text: str, data: Optional[Mapping]=None) -> str:
     if data is None:
-        data = load_data()
+        data = _data_view()
     blocks = _split_notification_blocks(text)
     kept = []
     for block in blocks:
@@ -3178,14 +4181,14 @@ def _strip_exact_command_blocks_from_notification_text(text: str, data: Optional
         kept.append(block)
     return '\n\n'.join(kept).strip()
 
-def _should_suppress_command_notification_text(text: str, data: Optional[dict]=None) -> bool:
+def _should_suppress_command_notification_text(text: str, data: Optional[Mapping]=None) -> bool:
     if data is None:
-        data = load_data()
+        data = _data_view()
     return _notification_text_has_exact_command_line(text, data)
 
 def _filter_notification_call(args: tuple, kwargs: dict) -> tuple[bool, tuple, dict]:
-    data = load_data()
-    cfg = _get_cfg(data)
+    data = _data_view()
+    cfg = _read_cfg(data)
     if not bool(cfg.get('plugin_enabled', True)):
         return (True, args, kwargs)
     if not args:
@@ -3319,166 +4322,798 @@ def _format_time_left(seconds: int) -> str:
         return f'{m}м'
     return f'{s}с'
 
+def _steam_time() -> float:
+    return time.time() + _steam_clock['offset']
+
+def _query_steam_time() -> int:
+    from urllib.request import Request, urlopen
+    request = Request(STEAM_TIME_URL, data=b'steamid=0', headers={'Accept': 'application/json', 'Content-Type': 'application/x-www-form-urlencoded', 'User-Agent': f'{NAME}/{VERSION}'})
+    started = time.time()
+    with urlopen(request, timeout=10) as response:
+        payload = json.loads(response.read(65536).decode('utf-8'))
+    local_mid = (started + time.time()) / 2
+    server_time = int((payload.get('response') or {}).get('server_time'))
+    return int(round(server_time - local_mid))
+
+def _sync_steam_time() -> bool:
+    if not STEAM_TIME_URL:
+        return False
+    try:
+        offset = _query_steam_time()
+    except Exception as e:
+        with _steam_clock_lock:
+            _steam_clock['error'] = f'{type(e).__name__}: {e}'
+        logger.warning(f'{PREFIX} steam time sync failed: {e}')
+        return False
+    now = time.time()
+    with _steam_clock_lock:
+        previous, synced_at = (_steam_clock['offset'], _steam_clock['synced_at'])
+        if synced_at:
+            _steam_clock['drift'] = (offset - previous) * 3600 / max(1.0, now - synced_at)
+        _steam_clock['offset'] = offset
+        _steam_clock['synced_at'] = now
+        _steam_clock['error'] = ''
+    if offset != previous:
+        logger.info(f'{PREFIX} steam time offset: {offset:+d}s')
+    return True
+
+def _steam_time_worker():
+    while True:
+        ok = _sync_steam_time()
+        time.sleep(STEAM_TIME_SYNC_INTERVAL if ok else STEAM_TIME_RETRY_INTERVAL)
+
+def _start_steam_time_sync():
+    with _steam_clock_lock:
+        if _steam_clock['started'] or not STEAM_TIME_URL:
+            return
+        _steam_clock['started'] = True
+    threading.Thread(target=_steam_time_worker, name='SDA-STEAM-TIME', daemon=True).start()
+
+def _steam_time_text() -> str:
+    with _steam_clock_lock:
+        clock = dict(_steam_clock)
+    if not STEAM_TIME_URL:
+        return 'Время Steam: <b>синхронизация выключена</b>'
+    if not clock['synced_at']:
+        return f"Время Steam: <b>не синхронизировано</b>{' | ' + escape(clock['error']) if clock['error'] else ''}"
+    text = f"Время Steam: смещение <b>{clock['offset']:+d}с</b> | дрейф: <b>{clock['drift']:+.2f}с/ч</b> | синхронизация: <code>{escape(_fmt_dt(int(clock['synced_at'])))}</code>"
+    if clock['error']:
+        text += f" | ошибка: {escape(clock['error'])}"
+    return text
+
 def _current_window() -> int:
-    return int(time.time()) // 30
+    return int(_steam_time()) // 30
+
+def _serving_window(now=None) -> int:
+    if now is None:
+        now = _steam_time()
+    window = int(now) // 30
+    if (window + 1) * 30 - now < CODE_MIN_VALIDITY:
+        return window + 1
+    return window
 
 def _seconds_to_next_slot(now: Optional[int]=None) -> int:
     if now is None:
-        now = int(time.time())
+        now = int(_steam_time())
     return 30 - now % 30
 
 def _account_key(owner_uid: str, acc: dict) -> str:
     return f"{owner_uid}::{_normalize_cmd(str(acc.get('command', '') or ''))}::{str(acc.get('name', '') or '')}"
 
-def _cleanup_queue_state(q: dict):
-    now = int(time.time())
-    for key, state in list(q.items()):
+def _build_command_index(data: Mapping) -> Mapping:
+    index: Dict[str, list] = {}
+    for owner_uid, accounts in _iter_owner_accounts(data):
+        for acc in accounts:
+            if not isinstance(acc, Mapping):
+                continue
+            cmd = _normalize_cmd(str(acc.get('command', '') or ''))
+            if cmd:
+                index.setdefault(cmd, []).append((owner_uid, acc))
+    return MappingProxyType({cmd: tuple(entries) for cmd, entries in index.items()})
+
+def _slot_key(acc: Mapping) -> str:
+    return f"slot::{_secret_fingerprint(str(acc.get('shared_secret') or ''))}"
+
+def _build_slot_index(data: Mapping) -> Mapping:
+    index: Dict[str, list] = {}
+    for owner_uid, accounts in _iter_owner_accounts(data):
+        for acc in accounts:
+            if isinstance(acc, Mapping):
+                index.setdefault(_slot_key(acc), []).append((owner_uid, acc))
+    return MappingProxyType({slot_key: tuple(entries) for slot_key, entries in index.items()})
+
+def _slot_index(data: Optional[Mapping]=None) -> Mapping:
+    return _snapshot_derived('slot_index', _build_slot_index, data)
+
+def _build_account_key_index(data: Mapping) -> Mapping:
+    index = {}
+    for owner_uid, accounts in _iter_owner_accounts(data):
+        for acc in accounts:
+            if isinstance(acc, Mapping):
+                index.setdefault(_account_key(owner_uid, acc), (owner_uid, acc))
+    return MappingProxyType(index)
+
+def _command_index(data: Optional[Mapping]=None) -> Mapping:
+    return _snapshot_derived('command_index', _build_command_index, data)
+
+def _build_command_prefilter(data: Mapping) -> Mapping:
+    commands = frozenset(_command_index(data))
+    first_chars = frozenset((cmd[0] for cmd in commands))
+    max_len = max(map(len, commands), default=0)
+    return MappingProxyType({'commands': commands, 'first_chars': first_chars, 'ascii_first': all((ch.isascii() for ch in first_chars)), 'max_raw_len': max_len * 8 + 64})
+
+def _leading_command_char(raw: str) -> str:
+    for ch in raw[:16]:
+        if ch.isspace() or _INVIS_RE.match(ch) or unicodedata.category(ch) in ('Cc', 'Cf'):
+            continue
+        lead = ''.join((c for c in unicodedata.normalize('NFKC', ch) if not c.isspace())).lower()
+        return lead[:1]
+    return ''
+
+def _match_command_text(raw_text: str, data: Optional[Mapping]=None) -> str:
+    raw = str(raw_text or '')
+    if not raw:
+        return ''
+    pf = _snapshot_derived('command_prefilter', _build_command_prefilter, data)
+    commands = pf['commands']
+    if not commands:
+        return ''
+    if raw.isascii():
+        text = raw.translate(_ASCII_CMD_DROP).lower()
+        return text if text in commands else ''
+    if len(raw) > pf['max_raw_len']:
+        return ''
+    if pf['ascii_first']:
+        lead = _leading_command_char(raw)
+        if lead and lead not in pf['first_chars']:
+            return ''
+    text = _normalize_cmd(raw)
+    return text if text in commands else ''
+
+def _account_key_index(data: Optional[Mapping]=None) -> Mapping:
+    return _snapshot_derived('account_key_index', _build_account_key_index, data)
+
+def _cleanup_queue_state(q: dict, keys=None):
+    now = int(_steam_time())
+    for key in list(q) if keys is None else keys:
+        state = q.get(key)
+        if state is None:
+            continue
         if not isinstance(state, dict):
             q.pop(key, None)
             continue
-        queue_arr = state.get('queue')
-        if not isinstance(queue_arr, list):
-            state['queue'] = []
-            queue_arr = state['queue']
-        fresh = []
-        for item in queue_arr:
-            try:
-                enq = int(item.get('enqueued_at') or now)
-                if now - enq <= 86400:
-                    fresh.append(item)
-            except Exception:
-                continue
-        state['queue'] = fresh
+        queue = state.get('queue')
+        if not isinstance(queue, _BuyerQueue):
+            queue = state['queue'] = _BuyerQueue()
+        while queue and now - int(queue.peek().get('enqueued_at') or now) > 86400:
+            queue.popleft()
         last_window = int(state.get('last_window') or -1)
         active_until = int(state.get('active_until') or 0)
         if active_until and now >= active_until:
             state['active_buyer'] = None
             state['active_chat_id'] = None
             state['active_until'] = 0
-        if not state.get('queue') and (not state.get('active_buyer')) and (last_window < _current_window() - 3):
+            state['window_buyers'] = []
+        if not queue and (not state.get('active_buyer')) and (last_window < _current_window() - 3):
             q.pop(key, None)
 
-def _ensure_queue_state(q: dict, account_key: str) -> dict:
-    st = q.get(account_key)
+def _ensure_queue_state(q: dict, slot_key: str) -> dict:
+    st = q.get(slot_key)
     if not isinstance(st, dict):
-        st = {'last_window': -1, 'active_buyer': None, 'active_chat_id': None, 'active_until': 0, 'queue': []}
-        q[account_key] = st
-    if not isinstance(st.get('queue'), list):
-        st['queue'] = []
+        st = {'last_window': -1, 'active_buyer': None, 'active_chat_id': None, 'active_until': 0, 'window_buyers': [], 'queue': _BuyerQueue()}
+        q[slot_key] = st
+    if not isinstance(st.get('queue'), _BuyerQueue):
+        st['queue'] = _BuyerQueue()
     return st
 
-def _find_queue_item(queue_arr: List[dict], buyer_id: str) -> Optional[int]:
-    for i, item in enumerate(queue_arr):
-        if str(item.get('buyer_id')) == str(buyer_id):
-            return i
-    return None
+def _account_slots(acc: Mapping) -> int:
+    try:
+        return max(1, min(ACCOUNT_MAX_SLOTS, int(acc.get('slots_per_window') or 1)))
+    except (TypeError, ValueError):
+        return 1
+
+def _slot_capacity(slot_key: str, data: Optional[Mapping]=None) -> int:
+    return min((_account_slots(acc) for _, acc in _slot_index(data).get(slot_key) or ()), default=1)
+
+def _window_buyers(st: dict, window: int) -> List[str]:
+    if int(st.get('last_window') or -1) != window:
+        return []
+    buyers = st.get('window_buyers')
+    if not isinstance(buyers, list):
+        buyers = [str(st['active_buyer'])] if st.get('active_buyer') else []
+    return buyers
+
+def _window_full(st: dict, window: int, capacity: int) -> bool:
+    last_window = int(st.get('last_window') or -1)
+    return last_window > window or (last_window == window and len(_window_buyers(st, window)) >= capacity)
+
+def _occupy_window(st: dict, window: int, buyer_id: str, chat_id):
+    buyers = [buyer for buyer in _window_buyers(st, window) if buyer != str(buyer_id)]
+    st['last_window'] = window
+    st['window_buyers'] = buyers + [str(buyer_id)]
+    st['active_buyer'] = str(buyer_id)
+    st['active_chat_id'] = chat_id
+    st['active_until'] = (window + 1) * 30
+
+def _account_item_matcher(owner_uid: str, acc: Mapping):
+    owner_uid, account_id, cmd = (str(owner_uid), str(acc.get('account_id') or ''), _normalize_cmd(str(acc.get('command') or '')))
+    return lambda item: item.get('owner_uid') == owner_uid and (item.get('account_id') == account_id if item.get('account_id') else item.get('command') == cmd)
+
+def _remove_queue_items(st: dict, match) -> int:
+    queue = st.get('queue')
+    if not isinstance(queue, _BuyerQueue):
+        return 0
+    removed = [item for item in queue.items() if match(item)]
+    for item in removed:
+        queue.remove(_queue_item_key(item))
+    return len(removed)
+
+def _find_queue_item(queue: _BuyerQueue, key: tuple) -> Optional[int]:
+    pos = queue.position(key)
+    return None if pos is None else pos - 1
 
 def _make_queue_item(owner_uid: str, acc: dict, buyer_id: str, chat_id, cmd: str, now: Optional[int]=None) -> dict:
     if now is None:
-        now = int(time.time())
-    return {'buyer_id': str(buyer_id), 'chat_id': chat_id, 'owner_uid': owner_uid, 'name': str(acc.get('name') or ''), 'command': cmd, 'shared_secret': str(acc.get('shared_secret') or ''), 'limit': acc.get('limit'), 'period_hours': acc.get('period_hours'), 'template': str(acc.get('template') or ''), 'enqueued_at': now}
+        now = int(_steam_time())
+    return {'buyer_id': str(buyer_id), 'chat_id': chat_id, 'command': cmd, 'account_id': str(acc.get('account_id') or ''), 'enqueued_at': now, 'owner_uid': str(owner_uid)}
 
-def _queue_delay_from_state(st: dict, now: Optional[int]=None) -> int:
+def _queue_delay_from_state(st: dict, now: Optional[int]=None, capacity: int=1) -> int:
     if now is None:
-        now = int(time.time())
-    if st.get('active_buyer'):
+        now = int(_steam_time())
+    if st.get('active_buyer') and _window_full(st, _serving_window(now), capacity):
         return max(1, int(st.get('active_until') or now) - now)
     return 1
 
+def _queue_eta(st: dict, pos: int, now: int, capacity: int) -> int:
+    return _queue_delay_from_state(st, now, capacity) + (pos - 1) // capacity * 30
+
 def _get_usage_record(usage: dict, owner_uid: str, buyer_id: str, cmd: str) -> dict:
     usage.setdefault(owner_uid, {}).setdefault(buyer_id, {})
     usage[owner_uid][buyer_id].setdefault(cmd, {'count': 0})
     return usage[owner_uid][buyer_id][cmd]
 
-def _check_limit_only(usage: dict, owner_uid: str, buyer_id: str, cmd: str, limit, period_hours, now: int):
-    if limit is None:
-        return (True, None, None)
-    limit = int(limit)
-    record = _get_usage_record(usage, owner_uid, buyer_id, cmd)
+def _roll_usage_window(record: dict, period_hours, now: int):
     if period_hours is None:
-        if int(record.get('count') or 0) >= limit:
-            return (False, f'❌ Лимит {limit} навсегда исчерпан.', 0)
-        return (True, None, None)
+        return
     period_seconds = int(period_hours) * 3600
     record.setdefault('reset_time', now + period_seconds)
     if now > int(record['reset_time']):
         record['count'] = 0
         record['reset_time'] = now + period_seconds
+
+def _check_limit_only(owner_uid: str, buyer_id: str, cmd: str, limit, period_hours, now: int):
+    if limit is None:
+        return (True, None, None)
+    limit = int(limit)
+    with _usage_stripes((owner_uid, buyer_id)):
+        conn = _usage_db()
+        if conn is not None:
+            record = _usage_db_record(conn, owner_uid, buyer_id, cmd)
+        else:
+            with _usage_lock:
+                record = dict(_get_usage_record(load_usage(), owner_uid, buyer_id, cmd))
+        pinned = period_hours is not None and int(record.get('count') or 0) > 0 and ('reset_time' not in record)
+        _roll_usage_window(record, period_hours, now)
+        if pinned:
+            if conn is not None:
+                _usage_db_store(conn, owner_uid, buyer_id, cmd, record)
+            else:
+                with _usage_lock:
+                    usage = load_usage()
+                    _get_usage_record(usage, owner_uid, buyer_id, cmd).update(record)
+                    save_usage(usage)
     if int(record.get('count') or 0) >= limit:
+        if period_hours is None:
+            return (False, f'❌ Лимит {limit} навсегда исчерпан.', 0)
         seconds_left = int(record['reset_time'] - now)
         return (False, f'❌ Лимит исчерпан. Новый запрос через {_format_time_left(seconds_left)}.', seconds_left)
     return (True, None, None)
 
-def _commit_usage_increment(usage: dict, owner_uid: str, buyer_id: str, cmd: str, limit, period_hours, now: int):
-    if limit is None:
-        return ('∞', '∞')
-    limit = int(limit)
-    record = _get_usage_record(usage, owner_uid, buyer_id, cmd)
-    if period_hours is not None:
-        period_seconds = int(period_hours) * 3600
-        record.setdefault('reset_time', now + period_seconds)
-        if now > int(record['reset_time']):
-            record['count'] = 0
-            record['reset_time'] = now + period_seconds
-    record['count'] = int(record.get('count') or 0) + 1
+def _usage_left_total(record: dict, limit: int, period_hours) -> tuple:
     left = max(0, limit - int(record['count']))
     total = '∞' if period_hours is None else str(limit)
     return (str(left), str(total))
 
-def _cancel_timer(account_key: str):
-    with _timer_lock:
-        timer = _queue_timers.pop(account_key, None)
-        if timer:
+def _commit_usage_increment(owner_uid: str, buyer_id: str, cmd: str, limit, period_hours, now: int, before_commit=None):
+    if limit is None and before_commit is None:
+        return ('∞', '∞')
+    left_total = ('∞', '∞')
+    with _usage_stripes((owner_uid, buyer_id)):
+        conn = _usage_db()
+        if conn is not None:
+            conn.execute('BEGIN IMMEDIATE')
             try:
-                timer.cancel()
+                if limit is not None:
+                    record = _usage_db_record(conn, owner_uid, buyer_id, cmd)
+                    _roll_usage_window(record, period_hours, now)
+                    record['count'] = int(record.get('count') or 0) + 1
+                    _usage_db_store(conn, owner_uid, buyer_id, cmd, record)
+                    left_total = _usage_left_total(record, int(limit), period_hours)
+                if before_commit is not None:
+                    before_commit(*left_total)
+                conn.execute('COMMIT')
             except Exception:
-                pass
+                conn.execute('ROLLBACK')
+                raise
+            return left_total
+        with _usage_lock:
+            if limit is not None:
+                usage = load_usage()
+                record = _get_usage_record(usage, owner_uid, buyer_id, cmd)
+                _roll_usage_window(record, period_hours, now)
+                record['count'] = int(record.get('count') or 0) + 1
+                left_total = _usage_left_total(record, int(limit), period_hours)
+            if before_commit is not None:
+                before_commit(*left_total)
+            if limit is not None:
+                save_usage(usage)
+        return left_total
+
+def _rollback_usage_increment(owner_uid: str, buyer_id: str, cmd: str, limit, period_hours):
+    if limit is None:
+        return
+    with _usage_stripes((owner_uid, buyer_id)):
+        conn = _usage_db()
+        if conn is not None:
+            conn.execute('UPDATE usage SET count = MAX(count - 1, 0) WHERE owner_uid = ? AND buyer_id = ? AND cmd = ?', (owner_uid, buyer_id, cmd))
+            return
+        with _usage_lock:
+            usage = load_usage()
+            record = usage.get(owner_uid, {}).get(buyer_id, {}).get(cmd)
+            if isinstance(record, dict) and int(record.get('count') or 0) > 0:
+                record['count'] = int(record['count']) - 1
+                save_usage(usage)
 
-def _schedule_queue_processing(cardinal: 'Cardinal', account_key: str, delay: int):
+def _compact_timer_heap():
+    if len(_timer_heap) > 64 and len(_timer_heap) > 2 * len(_queue_timers):
+        _timer_heap[:] = [entry for entry in _timer_heap if _queue_timers.get(entry[2]) == entry[1]]
+        heapq.heapify(_timer_heap)
 
-    def _runner():
-        current_timer = threading.current_thread()
-        try:
-            _process_queue_for_account(cardinal, account_key)
-        finally:
-            with _timer_lock:
-                if _queue_timers.get(account_key) is current_timer:
-                    _queue_timers.pop(account_key, None)
+def _cancel_timer(slot_key: str):
+    with _timer_lock:
+        if _queue_timers.pop(slot_key, None) is not None:
+            _compact_timer_heap()
+
+def _pop_due_timers(window: int) -> List[str]:
+    due = []
     with _timer_lock:
-        old = _queue_timers.get(account_key)
-        if old:
+        while _timer_heap and _timer_heap[0][0] <= window:
+            _, seq, key = heapq.heappop(_timer_heap)
+            if _queue_timers.get(key) == seq:
+                del _queue_timers[key]
+                due.append(key)
+    return due
+
+def _queue_pool() -> ThreadPoolExecutor:
+    global _queue_executor
+    with _timer_lock:
+        if _queue_executor is None:
+            _queue_executor = ThreadPoolExecutor(max_workers=QUEUE_WORKERS, thread_name_prefix='SDA-QUEUE')
+        return _queue_executor
+
+def _run_scheduled_queue(cardinal: 'Cardinal', slot_key: str):
+    try:
+        _process_queue_for_account(cardinal, slot_key)
+    except Exception as e:
+        logger.exception(f'{PREFIX} scheduled queue run failed: {e}')
+
+def _queue_tick_worker():
+    while True:
+        boundary = (int(_steam_time()) // 30 + 1) * 30
+        if boundary - _steam_time() > TOTP_PREWARM_LEAD:
+            time.sleep(boundary - _steam_time() - TOTP_PREWARM_LEAD)
             try:
-                old.cancel()
-            except Exception:
-                pass
-        t = threading.Timer(max(1, int(delay)), _runner)
-        t.daemon = True
-        _queue_timers[account_key] = t
-        t.start()
+                _prewarm_totp_codes(boundary // 30)
+            except Exception as e:
+                logger.error(f'{PREFIX} code prewarm failed: {e}')
+        time.sleep(max(0.0, boundary - _steam_time()) + QUEUE_TICK_LAG)
+        due = _pop_due_timers(_current_window())
+        with _timer_lock:
+            cardinal = _queue_tick_cardinal
+        if due and cardinal is not None:
+            try:
+                _serve_queue_heads(cardinal, due)
+            except Exception as e:
+                logger.exception(f'{PREFIX} queue tick failed: {e}')
 
-def _send_queue_position_message(cardinal: 'Cardinal', chat_id: int, pos: int, seconds_wait: int, total_people: int):
-    if pos <= 1:
-        text = f'⏳ Код сейчас занят. Ты следующий в очереди.\nПримерное ожидание: {seconds_wait}с.'
-    else:
-        text = f'⏳ Ты добавлен в очередь.\nПозиция: {pos}\nЛюдей в очереди: {total_people}\nПримерное ожидание: {seconds_wait}с.'
-    cardinal.account.send_message(chat_id, text)
+def _start_queue_tick(cardinal: 'Cardinal'):
+    global _queue_tick_thread, _queue_tick_cardinal
+    with _timer_lock:
+        _queue_tick_cardinal = cardinal
+        if _queue_tick_thread is None or not _queue_tick_thread.is_alive():
+            _queue_tick_thread = threading.Thread(target=_queue_tick_worker, name='SDA-QUEUE-TICK', daemon=True)
+            _queue_tick_thread.start()
+
+def _schedule_queue_processing(cardinal: 'Cardinal', slot_key: str, delay: int):
+    global _timer_seq
+    due_window = int(_steam_time() + max(1, int(delay))) // 30
+    _start_queue_tick(cardinal)
+    with _timer_lock:
+        if due_window > _current_window():
+            _timer_seq += 1
+            _queue_timers[slot_key] = _timer_seq
+            heapq.heappush(_timer_heap, (due_window, _timer_seq, slot_key))
+            _compact_timer_heap()
+            return
+        _queue_timers.pop(slot_key, None)
+    _queue_pool().submit(_run_scheduled_queue, cardinal, slot_key)
+
+def _load_outbox() -> Dict[str, dict]:
+    global _outbox_records, _outbox_seq
+    with _outbox_lock:
+        if _outbox_records is None:
+            raw = _store_load('outbox_records', OUTBOX_FILE)
+            _outbox_records = {str(k): v for k, v in (raw.items() if isinstance(raw, dict) else []) if isinstance(v, dict)}
+            _outbox_seq = max([int(k) for k in _outbox_records if k.isdigit()] + [_outbox_seq])
+        return _outbox_records
+
+def _outbox_rows(ids) -> Dict[str, Optional[str]]:
+    records = _load_outbox()
+    return {rid: _store_dump(records[rid]) if rid in records else None for rid in ids}
+
+def _save_outbox(*ids):
+    conn = _store_in_transaction()
+    if conn is not None:
+        with _outbox_lock:
+            _store_write(conn, 'outbox_records', lambda: _outbox_rows(ids))
+            _outbox_dirty.difference_update(ids)
+        return
+    with _outbox_lock:
+        _outbox_dirty.update(ids)
+    _flush_outbox()
 
-def _enqueue_buyer(cardinal: 'Cardinal', account_key: str, owner_uid: str, acc: dict, buyer_id: str, chat_id, cmd: str):
-    now = int(time.time())
-    with _queue_lock, _usage_lock:
+def _flush_outbox():
+    if not _outbox_dirty:
+        return
+    conn = _usage_db()
+    if conn is None:
+        with _outbox_lock:
+            ids = list(_outbox_dirty)
+            _outbox_dirty.clear()
+            try:
+                with open(OUTBOX_FILE + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(_load_outbox(), f, ensure_ascii=False, separators=(',', ':'))
+                os.replace(OUTBOX_FILE + '.tmp', OUTBOX_FILE)
+            except Exception as e:
+                _outbox_dirty.update(ids)
+                logger.error(f'{PREFIX} _save_json({OUTBOX_FILE}) error: {e}')
+        return
+    ids = []
+
+    def collect():
+        with _outbox_lock:
+            ids.extend(_outbox_dirty)
+            _outbox_dirty.clear()
+            return _outbox_rows(ids)
+    try:
+        _store_write(conn, 'outbox_records', collect)
+    except Exception as e:
+        with _outbox_lock:
+            _outbox_dirty.update(ids)
+        logger.error(f'{PREFIX} outbox store error: {e}')
+
+def _outbox_chat_blocked(rec: dict) -> bool:
+    chat = str(rec.get('chat_id'))
+    rid = int(rec['id'])
+    return any((str(other.get('chat_id')) == chat and int(other['id']) < rid for other in _load_outbox().values()))
+
+def _code_slot_key(code: dict) -> str:
+    if code.get('slot_key'):
+        return code['slot_key']
+    _, acc, _ = _find_live_account_by_key(code['account_key'])
+    return _slot_key(acc) if acc is not None else code['account_key']
+
+def _code_account(rec: dict) -> Optional[Mapping]:
+    code = rec['code']
+    if code.get('account_id') and code.get('slot_key'):
+        return _find_slot_entry(code['slot_key'], {'owner_uid': rec.get('owner_uid'), 'account_id': code['account_id'], 'command': code.get('cmd')})[1]
+    return _find_live_account_by_key(code.get('account_key') or '')[1]
+
+def _claim_code_window(rec: dict) -> bool:
+    code = rec['code']
+    window = _serving_window()
+    if int(code.get('window') or 0) >= window:
+        return True
+    slot_key = _code_slot_key(code)
+    with _queue_stripes(slot_key):
         q = load_queue()
-        usage = load_usage()
-        _cleanup_queue_state(q)
-        st = _ensure_queue_state(q, account_key)
-        ok, err_msg, _ = _check_limit_only(usage, owner_uid, buyer_id, cmd, acc.get('limit'), acc.get('period_hours'), now)
-        save_usage(usage)
-        if not ok:
-            save_queue(q)
-            cardinal.account.send_message(chat_id, err_msg)
-            _push_log(owner_uid, {'ts': now, 'type': 'LIMIT', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'msg': 'лимит не позволил встать в очередь'})
+        st = _ensure_queue_state(q, slot_key)
+        if _window_full(st, window, _slot_capacity(slot_key)) and str(code['buyer_id']) not in _window_buyers(st, window):
+            return False
+        _occupy_window(st, window, str(code['buyer_id']), rec.get('chat_id'))
+        save_queue(q, [slot_key])
+    code['window'] = window
+    return True
+
+def _release_code_window(code: dict):
+    slot_key = _code_slot_key(code)
+    with _queue_stripes(slot_key):
+        q = load_queue()
+        st = q.get(slot_key)
+        window = int(code.get('window') or 0)
+        if not isinstance(st, dict) or str(code['buyer_id']) not in _window_buyers(st, window):
+            return
+        buyers = [buyer for buyer in _window_buyers(st, window) if buyer != str(code['buyer_id'])]
+        if buyers:
+            st['window_buyers'] = buyers
+            st['active_buyer'] = buyers[-1]
+        else:
+            st['last_window'] = -1
+            st['active_buyer'] = None
+            st['active_chat_id'] = None
+            st['active_until'] = 0
+            st['window_buyers'] = []
+        save_queue(q, [slot_key])
+
+def _outbox_text(rec: dict) -> Optional[str]:
+    code = rec.get('code')
+    if not code:
+        return rec.get('text') or ''
+    acc = _code_account(rec)
+    if acc is None:
+        raise RuntimeError('аккаунт удалён')
+    if not _claim_code_window(rec):
+        return None
+    value = generate_steam_guard_code(str(acc.get('shared_secret') or ''), int(code['window']))
+    if not value:
+        raise RuntimeError('ошибка генерации')
+    text = _render_template(code['tpl'], {**code['vars'], 'code': value})
+    wait = int(code['window']) * 30 - int(_steam_time())
+    if wait > 0:
+        text += f'\n⏳ Код начнёт действовать через {wait}с.'
+    return text
+
+def _refill_send_bucket():
+    now = time.monotonic()
+    _send_bucket['tokens'] = min(float(SEND_BURST), _send_bucket['tokens'] + (now - _send_bucket['at']) * SEND_RATE)
+    _send_bucket['at'] = now
+
+def _acquire_send_token(priority: int) -> bool:
+    waiting = _send_bucket['waiting']
+    with _send_bucket_cond:
+        _refill_send_bucket()
+        if _send_bucket['tokens'] >= 1 and (not any(waiting[:priority + 1])):
+            _send_bucket['tokens'] -= 1
             return True
-        if str(st.get('active_buyer') or '') == str(buyer_id):
-            idx = _find_queue_item(st['queue'], buyer_id)
+        if priority >= SEND_PRIORITY_INFO:
+            _send_stats['dropped'] += 1
+            return False
+        _send_stats['delayed'] += 1
+        waiting[priority] += 1
+        try:
+            while True:
+                _refill_send_bucket()
+                if _send_bucket['tokens'] >= 1 and (not any(waiting[:priority])):
+                    _send_bucket['tokens'] -= 1
+                    return True
+                _send_bucket_cond.wait(max(0.02, (1 - _send_bucket['tokens']) / SEND_RATE))
+        finally:
+            waiting[priority] -= 1
+            _send_bucket_cond.notify_all()
+
+def _send_stats_text() -> str:
+    with _send_bucket_cond:
+        stats = dict(_send_stats)
+    return f"Отправка: <b>{stats['sent']}</b> | задержано: <b>{stats['delayed']}</b> | отброшено: <b>{stats['dropped']}</b> | объединено: <b>{stats['coalesced']}</b>"
+
+def _outbox_attempt(rec: dict):
+    with _outbox_lock:
+        records = _load_outbox()
+        blocked = _outbox_chat_blocked(rec)
+        stored = rec['id'] in records
+        if blocked and not stored:
+            rec.setdefault('next_at', 0)
+            records[rec['id']] = rec
+    if blocked:
+        if not stored:
+            _save_outbox(rec['id'])
+        return
+    priority = int(rec.get('priority') or 0)
+    if priority >= SEND_PRIORITY_INFO:
+        chat = str(rec.get('chat_id'))
+        with _outbox_lock:
+            latest = _outbox_latest_notice.get(chat)
+            if latest == rec['id']:
+                _outbox_latest_notice.pop(chat, None)
+        if latest != rec['id']:
+            with _send_bucket_cond:
+                _send_stats['coalesced'] += 1
+            _outbox_delivered({**rec, 'entry': None})
+            return
+    try:
+        text = _outbox_text(rec)
+    except Exception as e:
+        _outbox_failed(rec, e)
+        return
+    if text is None:
+        with _outbox_lock:
+            rec['next_at'] = time.time() + _seconds_to_next_slot()
+            _load_outbox()[rec['id']] = rec
+        _save_outbox(rec['id'])
+        with _outbox_lock:
+            _outbox_cond.notify()
+        return
+    if not _acquire_send_token(priority):
+        _outbox_delivered({**rec, 'entry': None})
+        return
+    try:
+        _outbox_cardinal.account.send_message(rec['chat_id'], text)
+    except Exception as e:
+        _outbox_failed(rec, e)
+        return
+    with _send_bucket_cond:
+        _send_stats['sent'] += 1
+    _outbox_delivered(rec)
+
+def _outbox_delivered(rec: dict):
+    with _outbox_lock:
+        records = _load_outbox()
+        if records.pop(rec['id'], None) is not None:
+            _outbox_dirty.add(rec['id'])
+        chat = str(rec.get('chat_id'))
+        waiting = [other for other in records.values() if str(other.get('chat_id')) == chat]
+        if waiting:
+            min(waiting, key=lambda other: int(other['id']))['next_at'] = 0
+            _outbox_cond.notify()
+    if rec.get('owner_uid') and rec.get('entry'):
+        _push_log(rec['owner_uid'], rec['entry'])
+
+def _outbox_failed(rec: dict, error: Exception):
+    rec['attempts'] = int(rec.get('attempts') or 0) + 1
+    logger.warning(f"{PREFIX} send to chat {rec.get('chat_id')} failed (attempt {rec['attempts']}/{OUTBOX_MAX_ATTEMPTS}): {error}")
+    if int(rec.get('priority') or 0) >= SEND_PRIORITY_INFO:
+        with _send_bucket_cond:
+            _send_stats['dropped'] += 1
+        _outbox_delivered({**rec, 'entry': None})
+        return
+    if rec['attempts'] < OUTBOX_MAX_ATTEMPTS:
+        with _outbox_lock:
+            rec['next_at'] = time.time() + min(OUTBOX_RETRY_CAP, OUTBOX_RETRY_BASE * 2 ** (rec['attempts'] - 1))
+            _load_outbox()[rec['id']] = rec
+        _save_outbox(rec['id'])
+        with _outbox_lock:
+            _outbox_cond.notify()
+        return
+    entry = rec.get('entry') or {}
+    code = rec.get('code')
+    if code:
+        try:
+            _rollback_usage_increment(rec.get('owner_uid') or '', code['buyer_id'], code['cmd'], code.get('limit'), code.get('period_hours'))
+            _release_code_window(code)
+            if _outbox_cardinal is not None:
+                _schedule_queue_processing(_outbox_cardinal, _code_slot_key(code), 1)
+        except Exception as e:
+            logger.error(f'{PREFIX} outbox rollback failed: {e}')
+    if rec.get('owner_uid'):
+        failed = {key: entry[key] for key in ('name', 'cmd', 'buyer') if key in entry}
+        failed.update({'ts': int(time.time()), 'type': 'ERROR', 'msg': f"сообщение покупателю не доставлено ({entry.get('type') or 'REPLY'}, попыток: {rec['attempts']}): {type(error).__name__}: {error}" + ('; лимит возвращён' if code else '')})
+        _push_log(rec['owner_uid'], failed)
+    _outbox_delivered({**rec, 'entry': None})
+
+def _outbox_retry_worker():
+    while True:
+        due = []
+        with _outbox_cond:
+            now = time.time()
+            heads = {}
+            for rec in _load_outbox().values():
+                chat = str(rec.get('chat_id'))
+                if chat not in heads or int(rec['id']) < int(heads[chat]['id']):
+                    heads[chat] = rec
+            wait = 5.0
+            for rec in heads.values():
+                if rec['id'] in _outbox_inflight:
+                    continue
+                next_at = float(rec.get('next_at') or 0)
+                if next_at <= now:
+                    due.append(rec)
+                else:
+                    wait = min(wait, next_at - now)
+            if not due:
+                _outbox_cond.wait(wait)
+                continue
+        if _outbox_cardinal is None:
+            time.sleep(1)
+            continue
+        for rec in due:
+            _outbox_attempt(rec)
+
+def _start_outbox_retry(cardinal: 'Cardinal'):
+    global _outbox_cardinal, _outbox_retry_started
+    _start_store_flusher()
+    with _outbox_lock:
+        _outbox_cardinal = cardinal
+        if _outbox_retry_started:
+            return
+        _outbox_retry_started = True
+    threading.Thread(target=_outbox_retry_worker, name='SDA-OUTBOX-RETRY', daemon=True).start()
+
+def _outbox_worker(lane: Queue):
+    while True:
+        rec = lane.get()
+        try:
+            _outbox_attempt(rec)
+        except Exception as e:
+            logger.exception(f'{PREFIX} outbox worker error: {e}')
+        finally:
+            with _outbox_lock:
+                _outbox_inflight.discard(rec['id'])
+
+def _outbox() -> List[Queue]:
+    global _outbox_lanes
+    if _outbox_lanes:
+        return _outbox_lanes
+    with _outbox_lock:
+        if not _outbox_lanes:
+            lanes = []
+            for idx in range(OUTBOX_WORKERS):
+                lane = Queue(maxsize=OUTBOX_QUEUE_SIZE)
+                threading.Thread(target=_outbox_worker, args=(lane,), name=f'SDA-OUTBOX-{idx}', daemon=True).start()
+                lanes.append(lane)
+            _outbox_lanes = lanes
+    return _outbox_lanes
+
+def _send_to_buyer(cardinal: 'Cardinal', chat_id, text: str, owner_uid: str='', entry: Optional[dict]=None, code: Optional[dict]=None, priority: int=SEND_PRIORITY_REPLY):
+    _dispatch_outbox(cardinal, _stage_outbox_record(chat_id, text, owner_uid, entry, code, priority))
+
+def _stage_outbox_record(chat_id, text: str, owner_uid: str='', entry: Optional[dict]=None, code: Optional[dict]=None, priority: int=SEND_PRIORITY_REPLY) -> dict:
+    global _outbox_seq
+    with _outbox_lock:
+        _load_outbox()
+        _outbox_seq += 1
+        rec = {'id': str(_outbox_seq), 'chat_id': chat_id, 'text': text, 'owner_uid': str(owner_uid or ''), 'entry': entry, 'attempts': 0, 'priority': SEND_PRIORITY_CODE if code else priority}
+        if priority >= SEND_PRIORITY_INFO:
+            _outbox_latest_notice[str(chat_id)] = rec['id']
+        if code:
+            rec['code'] = code
+            rec['text'] = ''
+            _outbox_records[rec['id']] = rec
+            _outbox_inflight.add(rec['id'])
+    if code:
+        _save_outbox(rec['id'])
+    return rec
+
+def _discard_outbox_record(rec: dict):
+    with _outbox_lock:
+        stored = _load_outbox().pop(rec['id'], None) is not None
+        _outbox_inflight.discard(rec['id'])
+        if _outbox_latest_notice.get(str(rec['chat_id'])) == rec['id']:
+            _outbox_latest_notice.pop(str(rec['chat_id']), None)
+    if stored:
+        _save_outbox(rec['id'])
+
+def _dispatch_outbox(cardinal: 'Cardinal', rec: dict):
+    _start_outbox_retry(cardinal)
+    lanes = _outbox()
+    lane = lanes[hash(str(rec['chat_id'])) % len(lanes)]
+    uow = _active_unit_of_work()
+    if uow is not None:
+        uow.sends.append((lane, rec))
+        return
+    lane.put(rec)
+
+def _queue_position_text(pos: int, seconds_wait: int, total_people: int) -> str:
+    if pos <= 1:
+        return f'⏳ Код сейчас занят. Ты следующий в очереди.\nПримерное ожидание: {seconds_wait}с.'
+    return f'⏳ Ты добавлен в очередь.\nПозиция: {pos}\nЛюдей в очереди: {total_people}\nПримерное ожидание: {seconds_wait}с.'
+
+def _enqueue_buyer(cardinal: 'Cardinal', slot_key: str, owner_uid: str, acc: dict, buyer_id: str, chat_id, cmd: str):
+    now = int(_steam_time())
+    entry = None
+    delay = None
+    priority = SEND_PRIORITY_INFO
+    with _queue_stripes(slot_key):
+        q = load_queue()
+        _cleanup_queue_state(q, [slot_key])
+        st = _ensure_queue_state(q, slot_key)
+        ok, err_msg, _ = _check_limit_only(owner_uid, buyer_id, cmd, acc.get('limit'), acc.get('period_hours'), now)
+        if not ok:
+            save_queue(q, [slot_key])
+            reply = err_msg
+            priority = SEND_PRIORITY_REPLY
+            entry = {'ts': now, 'type': 'LIMIT', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'msg': 'лимит не позволил встать в очередь'}
+        elif str(buyer_id) in _window_buyers(st, int(st.get('last_window') or -1)):
+            idx = _find_queue_item(st['queue'], (str(buyer_id), str(owner_uid), cmd))
             if idx is None:
                 st['queue'].append(_make_queue_item(owner_uid, acc, buyer_id, chat_id, cmd, now))
                 pos = len(st['queue'])
@@ -3488,234 +5123,244 @@ def _enqueue_buyer(cardinal: 'Cardinal', account_key: str, owner_uid: str, acc:
                 pos = idx + 1
                 msg_prefix = '⏳ Ты уже есть в очереди на следующий код.'
                 _log_event(str(owner_uid), 'QUEUE', 'Повторный запрос: покупатель уже в очереди', name=str(acc.get('name') or ''), cmd=cmd, buyer=buyer_id, position=pos)
-            active_left = _queue_delay_from_state(st, now)
-            eta = active_left + (pos - 1) * 30
-            save_queue(q)
-            cardinal.account.send_message(chat_id, f'{msg_prefix}\nПозиция: {pos}\nПримерное ожидание: {eta}с.')
-            _schedule_queue_processing(cardinal, account_key, active_left)
-            return True
-        idx = _find_queue_item(st['queue'], buyer_id)
-        if idx is not None:
-            pos = idx + 1
-            active_slot = 1 if st.get('active_buyer') else 0
-            eta = _queue_delay_from_state(st, now) + (pos - 1) * 30
-            delay = _queue_delay_from_state(st, now)
-            save_queue(q)
-            _log_event(str(owner_uid), 'QUEUE', 'Показана текущая позиция в очереди', name=str(acc.get('name') or ''), cmd=cmd, buyer=buyer_id, position=pos)
-            _send_queue_position_message(cardinal, chat_id, pos, eta, len(st['queue']) + active_slot)
-            _schedule_queue_processing(cardinal, account_key, delay)
-            return True
-        item = _make_queue_item(owner_uid, acc, buyer_id, chat_id, cmd, now)
-        st['queue'].append(item)
-        _log_event(str(owner_uid), 'QUEUE', 'Покупатель добавлен в очередь', name=str(acc.get('name') or ''), cmd=cmd, buyer=buyer_id, position=len(st['queue']))
-        save_queue(q)
-        pos = len(st['queue'])
-        active_slot = 1 if st.get('active_buyer') else 0
-        delay = _queue_delay_from_state(st, now)
-        eta = delay + (pos - 1) * 30
-        _send_queue_position_message(cardinal, chat_id, pos, eta, len(st['queue']) + active_slot)
-    _schedule_queue_processing(cardinal, account_key, delay)
+            capacity = _slot_capacity(slot_key)
+            delay = _queue_delay_from_state(st, now, capacity)
+            eta = _queue_eta(st, pos, now, capacity)
+            save_queue(q, [slot_key])
+            reply = f'{msg_prefix}\nПозиция: {pos}\nПримерное ожидание: {eta}с.'
+        else:
+            idx = _find_queue_item(st['queue'], (str(buyer_id), str(owner_uid), cmd))
+            if idx is not None:
+                pos = idx + 1
+                _log_event(str(owner_uid), 'QUEUE', 'Показана текущая позиция в очереди', name=str(acc.get('name') or ''), cmd=cmd, buyer=buyer_id, position=pos)
+            else:
+                st['queue'].append(_make_queue_item(owner_uid, acc, buyer_id, chat_id, cmd, now))
+                pos = len(st['queue'])
+                _log_event(str(owner_uid), 'QUEUE', 'Покупатель добавлен в очередь', name=str(acc.get('name') or ''), cmd=cmd, buyer=buyer_id, position=pos)
+            save_queue(q, [slot_key])
+            capacity = _slot_capacity(slot_key)
+            active_slots = len(_window_buyers(st, int(st.get('last_window') or -1))) if st.get('active_buyer') else 0
+            delay = _queue_delay_from_state(st, now, capacity)
+            eta = _queue_eta(st, pos, now, capacity)
+            reply = _queue_position_text(pos, eta, len(st['queue']) + active_slots)
+    _send_to_buyer(cardinal, chat_id, reply, owner_uid, entry, priority=priority)
+    if delay is not None:
+        _schedule_queue_processing(cardinal, slot_key, delay)
     return True
 
-def _process_queue_for_account(cardinal: 'Cardinal', account_key: str):
+def _take_queue_head(q: dict, slot_key: str, now: int) -> Optional[dict]:
+    st = q.get(slot_key)
+    if not isinstance(st, dict):
+        return None
+    queue_arr = st.get('queue') or []
+    if not queue_arr:
+        st['active_buyer'] = None
+        st['active_chat_id'] = None
+        st['active_until'] = 0
+        return None
+    serve_window = _serving_window(now)
+    if _window_full(st, serve_window, _slot_capacity(slot_key)):
+        return {'kind': 'wait', 'slot_key': slot_key}
+    served = set(_window_buyers(st, serve_window))
+    item = queue_arr.peek()
+    if item['buyer_id'] in served:
+        item = next((other for other in queue_arr.items() if other['buyer_id'] not in served), None)
+        if item is None:
+            return {'kind': 'wait', 'slot_key': slot_key}
+    queue_arr.remove(_queue_item_key(item))
+    owner_uid, acc, cfg = _find_slot_entry(slot_key, item)
+    if acc is None or not _account_queue_effective(acc, cfg):
+        return {'kind': 'dropped', 'slot_key': slot_key, 'owner_uid': str(item.get('owner_uid') or ''), 'buyer_id': str(item.get('buyer_id') or ''), 'chat_id': item.get('chat_id'), 'name': str(acc.get('name') or '') if acc is not None else '', 'cmd': str(item.get('command') or ''), 'reason': 'deleted' if acc is None else 'queue_off', 'more': bool(queue_arr)}
+    with _usage_stripes((str(owner_uid), str(item.get('buyer_id') or ''))):
+        return _issue_queue_item(q, slot_key, owner_uid, acc, item, serve_window, now, bool(queue_arr))
+
+def _charge_code_delivery(q: dict, slot_key: str, window: int, owner_uid: str, buyer_id: str, chat_id, cmd: str, limit, period_hours, now: int, build) -> tuple:
+    st = q[slot_key]
+    staged = []
+
+    def stage(left, total):
+        entry, code = build(left, total)
+        staged.append(_stage_outbox_record(chat_id, '', owner_uid, entry, code))
+        _occupy_window(st, window, str(buyer_id), chat_id)
+        save_queue(q, [slot_key])
     try:
-        _, live_acc, live_cfg = _find_live_account_by_key(account_key)
-        if live_acc is None or not _account_queue_effective(live_acc, live_cfg):
-            return
-        now = int(time.time())
-        with _queue_lock, _usage_lock:
-            q = load_queue()
-            usage = load_usage()
-            _cleanup_queue_state(q)
-            st = q.get(account_key)
-            if not isinstance(st, dict):
-                save_queue(q)
-                save_usage(usage)
-                return
-            queue_arr = st.get('queue') or []
-            if not queue_arr:
-                st['active_buyer'] = None
-                st['active_chat_id'] = None
-                st['active_until'] = 0
-                save_queue(q)
-                save_usage(usage)
-                return
-            current_window = _current_window()
-            last_window = int(st.get('last_window') or -1)
-            if last_window == current_window:
-                delay = _seconds_to_next_slot(now)
-                save_queue(q)
-                save_usage(usage)
-                _schedule_queue_processing(cardinal, account_key, delay)
-                return
-            item = queue_arr.pop(0)
-            owner_uid = str(item.get('owner_uid') or '')
-            buyer_id = str(item.get('buyer_id') or '')
-            chat_id = item.get('chat_id')
-            name = str(item.get('name') or '')
-            cmd = str(item.get('command') or '')
-            shared = str(item.get('shared_secret') or '')
-            limit = item.get('limit')
-            period_hours = item.get('period_hours')
-            account_template = str(item.get('template') or '')
-            ok, err_msg, wait_seconds = _check_limit_only(usage, owner_uid, buyer_id, cmd, limit, period_hours, now)
-            if not ok:
-                save_usage(usage)
-                save_queue(q)
-                try:
-                    cardinal.account.send_message(chat_id, err_msg)
-                except Exception:
-                    pass
-                _push_log(owner_uid, {'ts': now, 'type': 'LIMIT', 'name': name, 'cmd': cmd, 'buyer': buyer_id, 'msg': f'очередь снята лимитом ({wait_seconds or 0}s)'})
-                if st.get('queue'):
-                    delay = _seconds_to_next_slot(now)
-                    _schedule_queue_processing(cardinal, account_key, delay)
-                return
-            code = generate_steam_guard_code(shared)
-            if not code:
-                save_usage(usage)
-                save_queue(q)
-                try:
-                    cardinal.account.send_message(chat_id, '❌ Ошибка генерации.')
-                except Exception:
-                    pass
-                _push_log(owner_uid, {'ts': now, 'type': 'ERROR', 'name': name, 'cmd': cmd, 'buyer': buyer_id, 'msg': 'ошибка генерации из очереди'})
-                if st.get('queue'):
-                    delay = _seconds_to_next_slot(now)
-                    _schedule_queue_processing(cardinal, account_key, delay)
-                return
-            left, total = _commit_usage_increment(usage, owner_uid, buyer_id, cmd, limit, period_hours, now)
-            st['last_window'] = current_window
-            st['active_buyer'] = buyer_id
-            st['active_chat_id'] = chat_id
-            st['active_until'] = (current_window + 1) * 30
-            save_usage(usage)
-            save_queue(q)
-        data = load_data()
-        cfg = _get_cfg(data)
-        tpl = _get_template_by_mode(account_template, cfg)
-        msg = _render_template(tpl, {'code': code, 'name': name, 'command': cmd, 'left': str(left), 'total': str(total), 'limit_text': _limit_text({'limit': limit, 'period_hours': period_hours})})
-        cardinal.account.send_message(chat_id, msg)
-        _push_log(owner_uid, {'ts': now, 'type': 'CODE', 'name': name, 'cmd': cmd, 'buyer': buyer_id, 'msg': f'выдан из очереди, осталось {left}/{total}'})
-        with _queue_lock:
-            q = load_queue()
-            st = q.get(account_key)
-            _, live_acc, live_cfg = _find_live_account_by_key(account_key)
-            if isinstance(st, dict) and st.get('queue') and (live_acc is not None) and _account_queue_effective(live_acc, live_cfg):
-                delay = _seconds_to_next_slot()
-                save_queue(q)
-                _schedule_queue_processing(cardinal, account_key, delay)
+        left, total = _commit_usage_increment(owner_uid, buyer_id, cmd, limit, period_hours, now, stage)
+    except Exception:
+        for rec in staged:
+            _discard_outbox_record(rec)
+            _release_code_window(rec['code'])
+        _queue_rows.pop(slot_key, None)
+        save_queue(q, [slot_key])
+        raise
+    return (left, total, staged[0])
+
+def _issue_queue_item(q: dict, slot_key: str, owner_uid: str, acc: Mapping, item: dict, serve_window: int, now: int, more: bool) -> dict:
+    job = {'kind': 'code', 'slot_key': slot_key, 'account_id': str(acc.get('account_id') or ''), 'owner_uid': str(owner_uid), 'buyer_id': str(item.get('buyer_id') or ''), 'chat_id': item.get('chat_id'), 'name': str(acc.get('name') or ''), 'cmd': str(item.get('command') or ''), 'limit': acc.get('limit'), 'period_hours': acc.get('period_hours'), 'template': str(acc.get('template') or ''), 'more': more}
+    ok, err_msg, wait_seconds = _check_limit_only(job['owner_uid'], job['buyer_id'], job['cmd'], job['limit'], job['period_hours'], now)
+    if not ok:
+        job.update(kind='limit', text=err_msg, wait_seconds=wait_seconds)
+        return job
+    code = generate_steam_guard_code(str(acc.get('shared_secret') or ''), serve_window)
+    if not code:
+        job['kind'] = 'error'
+        return job
+    tpl = _get_template_by_mode(job['template'], _read_cfg())
+
+    def build(left, total):
+        entry = {'ts': now, 'type': 'CODE', 'name': job['name'], 'cmd': job['cmd'], 'buyer': job['buyer_id'], 'msg': f'выдан из очереди, осталось {left}/{total}'}
+        delivery = {'account_id': job['account_id'], 'slot_key': slot_key, 'buyer_id': job['buyer_id'], 'cmd': job['cmd'], 'limit': job['limit'], 'period_hours': job['period_hours'], 'window': serve_window, 'tpl': tpl, 'vars': {'name': job['name'], 'command': job['cmd'], 'left': str(left), 'total': str(total), 'limit_text': _limit_text(acc)}}
+        return (entry, delivery)
+    rec = _charge_code_delivery(q, slot_key, serve_window, job['owner_uid'], job['buyer_id'], job['chat_id'], job['cmd'], job['limit'], job['period_hours'], now, build)[2]
+    job.update(window=serve_window, rec=rec)
+    return job
+
+def _deliver_queue_job(cardinal: 'Cardinal', job: dict, now: int):
+    kind = job['kind']
+    owner_uid, buyer_id, chat_id, name, cmd = (job.get('owner_uid'), job.get('buyer_id'), job.get('chat_id'), job.get('name'), job.get('cmd'))
+    try:
+        if kind == 'limit':
+            _send_to_buyer(cardinal, chat_id, job['text'], owner_uid, {'ts': now, 'type': 'LIMIT', 'name': name, 'cmd': cmd, 'buyer': buyer_id, 'msg': f"очередь снята лимитом ({job.get('wait_seconds') or 0}s)"})
+        elif kind == 'dropped':
+            if job['reason'] == 'deleted':
+                text, msg = ('❌ Аккаунт больше недоступен, очередь за кодом отменена.', 'снят из очереди: аккаунт удалён')
             else:
-                save_queue(q)
+                text, msg = ('❌ Очередь для этого аккаунта выключена. Отправь команду ещё раз.', 'снят из очереди: очередь выключена')
+            _send_to_buyer(cardinal, chat_id, text, owner_uid, {'ts': now, 'type': 'QUEUE', 'name': name, 'cmd': cmd, 'buyer': buyer_id, 'msg': msg})
+        elif kind == 'error':
+            _send_to_buyer(cardinal, chat_id, '❌ Ошибка генерации.', owner_uid, {'ts': now, 'type': 'ERROR', 'name': name, 'cmd': cmd, 'buyer': buyer_id, 'msg': 'ошибка генерации из очереди'})
+        elif kind == 'code':
+            _dispatch_outbox(cardinal, job['rec'])
     except Exception as e:
         logger.exception(f'{PREFIX} _process_queue_for_account error: {e}')
         _log_error_for_all_owners('_process_queue_for_account', e)
+    if kind == 'wait' or job.get('more'):
+        if _slot_queue_effective(job['slot_key']):
+            _schedule_queue_processing(cardinal, job['slot_key'], max(1, (int(job.get('window') or now // 30) + 1) * 30 - now))
 
-def _issue_now(cardinal: 'Cardinal', owner_uid: str, acc: dict, buyer_id: str, chat_id, cmd: str):
-    now = int(time.time())
-    account_key = _account_key(owner_uid, acc)
-    with _queue_lock, _usage_lock:
-        q = load_queue()
-        usage = load_usage()
-        _cleanup_queue_state(q)
-        st = _ensure_queue_state(q, account_key)
-        ok, err_msg, wait_seconds = _check_limit_only(usage, owner_uid, buyer_id, cmd, acc.get('limit'), acc.get('period_hours'), now)
-        if not ok:
-            save_usage(usage)
-            save_queue(q)
-            cardinal.account.send_message(chat_id, err_msg)
-            _push_log(owner_uid, {'ts': now, 'type': 'LIMIT', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'msg': f'лимит исчерпан ({wait_seconds or 0}s)'})
-            return True
-        code = generate_steam_guard_code(str(acc.get('shared_secret') or ''))
-        if not code:
-            save_usage(usage)
-            save_queue(q)
-            cardinal.account.send_message(chat_id, '❌ Ошибка генерации.')
-            _push_log(owner_uid, {'ts': now, 'type': 'ERROR', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'msg': 'ошибка генерации'})
-            return True
-        left, total = _commit_usage_increment(usage, owner_uid, buyer_id, cmd, acc.get('limit'), acc.get('period_hours'), now)
-        current_window = _current_window()
-        st['last_window'] = current_window
-        st['active_buyer'] = buyer_id
-        st['active_chat_id'] = chat_id
-        st['active_until'] = (current_window + 1) * 30
-        save_usage(usage)
-        save_queue(q)
-    data = load_data()
-    cfg = _get_cfg(data)
+def _serve_queue_heads(cardinal: 'Cardinal', slot_keys: List[str]):
+    with _unit_of_work():
+        _serve_queue_heads_batch(cardinal, slot_keys)
+
+def _serve_queue_heads_batch(cardinal: 'Cardinal', slot_keys: List[str]):
+    if not _plugin_enabled() or not _queue_enabled():
+        return
+    now = int(_steam_time())
+    jobs = []
+    failed = []
+    for slot_key in slot_keys:
+        try:
+            with _queue_stripes(slot_key):
+                q = load_queue()
+                _cleanup_queue_state(q, [slot_key])
+                while True:
+                    job = _take_queue_head(q, slot_key, now)
+                    if job is None:
+                        break
+                    jobs.append(job)
+                    if job['kind'] not in ('code', 'dropped') or not job['more']:
+                        break
+                save_queue(q, [slot_key])
+        except Exception as e:
+            logger.exception(f'{PREFIX} _process_queue_for_account error: {e}')
+            _log_error_for_all_owners('_process_queue_for_account', e)
+            failed.append(slot_key)
+    for job in jobs:
+        _deliver_queue_job(cardinal, job, now)
+    for slot_key in failed:
+        _schedule_queue_processing(cardinal, slot_key, max(1, (now // 30 + 1) * 30 - now))
+
+def _process_queue_for_account(cardinal: 'Cardinal', slot_key: str):
+    _serve_queue_heads(cardinal, [slot_key])
+
+def _issue_now(cardinal: 'Cardinal', owner_uid: str, acc: dict, buyer_id: str, chat_id, cmd: str) -> tuple[bool, int]:
+    now = int(_steam_time())
+    slot_key = _slot_key(acc)
+    cfg = _read_cfg()
     tpl = _get_account_template(acc, cfg)
-    msg = _render_template(tpl, {'code': code, 'name': str(acc.get('name') or ''), 'command': cmd, 'left': str(left), 'total': str(total), 'limit_text': _limit_text(acc)})
-    cardinal.account.send_message(chat_id, msg)
-    _push_log(owner_uid, {'ts': now, 'type': 'CODE', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'msg': f'выдан, осталось {left}/{total}'})
-    data = load_data()
-    cfg = _get_cfg(data)
+    with _queue_stripes(slot_key), _usage_stripes((str(owner_uid), str(buyer_id))):
+        q = load_queue()
+        _cleanup_queue_state(q, [slot_key])
+        st = _ensure_queue_state(q, slot_key)
+        serve_window = _serving_window()
+        if _window_full(st, serve_window, _slot_capacity(slot_key)) or str(buyer_id) in _window_buyers(st, serve_window) or (_account_queue_effective(acc, cfg) and st['queue']):
+            return (False, max(1, int(st.get('active_until') or 0) - now))
+        ok, err_msg, wait_seconds = _check_limit_only(owner_uid, buyer_id, cmd, acc.get('limit'), acc.get('period_hours'), now)
+        code = generate_steam_guard_code(str(acc.get('shared_secret') or ''), serve_window) if ok else None
+        if ok and code:
+
+            def build(left, total):
+                entry = {'ts': now, 'type': 'CODE', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'msg': f'выдан, осталось {left}/{total}'}
+                delivery = {'account_id': str(acc.get('account_id') or ''), 'slot_key': slot_key, 'buyer_id': buyer_id, 'cmd': cmd, 'limit': acc.get('limit'), 'period_hours': acc.get('period_hours'), 'window': serve_window, 'tpl': tpl, 'vars': {'name': str(acc.get('name') or ''), 'command': cmd, 'left': str(left), 'total': str(total), 'limit_text': _limit_text(acc)}}
+                return (entry, delivery)
+            rec = _charge_code_delivery(q, slot_key, serve_window, owner_uid, buyer_id, chat_id, cmd, acc.get('limit'), acc.get('period_hours'), now, build)[2]
+        save_queue(q, [slot_key])
+    if not ok:
+        _send_to_buyer(cardinal, chat_id, err_msg, owner_uid, {'ts': now, 'type': 'LIMIT', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'msg': f'лимит исчерпан ({wait_seconds or 0}s)'})
+        return (True, 0)
+    if not code:
+        _send_to_buyer(cardinal, chat_id, '❌ Ошибка генерации.', owner_uid, {'ts': now, 'type': 'ERROR', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'msg': 'ошибка генерации'})
+        return (True, 0)
+    _dispatch_outbox(cardinal, rec)
     if _account_queue_effective(acc, cfg):
-        delay = _seconds_to_next_slot(now)
-        _schedule_queue_processing(cardinal, account_key, delay)
-    return True
+        delay = max(1, (serve_window + 1) * 30 - now)
+        _schedule_queue_processing(cardinal, slot_key, delay)
+    return (True, 0)
 
 def new_message_handler(cardinal: 'Cardinal', event: NewMessageEvent):
+    with _unit_of_work():
+        return _handle_new_message(cardinal, event)
+
+def _handle_new_message(cardinal: 'Cardinal', event: NewMessageEvent):
     try:
         _patch_new_message_notifications(cardinal)
         raw_text = _get_text_from_event_message(event.message)
-        text = _normalize_cmd(raw_text)
+        data = _data_view()
+        text = _match_command_text(raw_text, data)
         if not text:
             return
+        entries = _command_index(data).get(text)
+        if not entries:
+            return
+        cfg = _read_cfg(data)
+        if not bool(cfg.get('plugin_enabled', True)):
+            return
         buyer_id = _get_buyer_id_from_event_message(event.message)
         buyer_nick = _get_buyer_nick_from_event_message(event.message) or buyer_id
         chat_id = getattr(event.message, 'chat_id', None)
         if chat_id is None:
             return
-        data = load_data()
-        cfg = _get_cfg(data)
-        if not bool(cfg.get('plugin_enabled', True)):
+        owner_uid, acc = entries[0]
+        cmd = text
+        _log_event(str(owner_uid), 'COMMAND', 'Команда распознана', name=str(acc.get('name') or ''), cmd=cmd, buyer=str(buyer_id), nick=str(buyer_nick))
+        account_enabled = bool(acc.get('enabled', True))
+        account_queue_enabled = bool(cfg.get('queue_enabled', True)) and bool(acc.get('queue_enabled', True))
+        if not _account_command_notifications_effective(acc, cfg):
+            _notify_debug('exact_sda_command_matched', chat_id=str(chat_id), buyer_id=str(buyer_id), buyer_nick=str(buyer_nick), cmd=str(cmd), raw_text=str(raw_text), account_name=str(acc.get('name') or ''))
+            _mark_recent_command_notification_suppression(chat_id=chat_id, buyer_id=buyer_id, cmd=cmd, raw_text=raw_text)
+        if not account_enabled:
+            _send_to_buyer(cardinal, chat_id, '❌ Выдача кодов для этого аккаунта временно отключена.', owner_uid, {'ts': int(time.time()), 'type': 'DISABLED', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'nick': buyer_nick, 'msg': 'выдача кодов аккаунта выключена'})
+            return True
+        if _try_blacklist_reject(cardinal, str(owner_uid), acc, buyer_id, buyer_nick, chat_id, cmd, cfg):
+            return True
+        slot_key = _slot_key(acc)
+        with _queue_stripes(slot_key):
+            q = load_queue()
+            _cleanup_queue_state(q, [slot_key])
+            st = _ensure_queue_state(q, slot_key)
+            now = int(_steam_time())
+            serve_window = _serving_window()
+            active_until = int(st.get('active_until') or 0)
+            current_busy = _window_full(st, serve_window, _slot_capacity(slot_key, data)) and active_until > now or str(buyer_id) in _window_buyers(st, serve_window) or (account_queue_enabled and bool(st['queue']))
+            busy_seconds = max(1, active_until - now)
+            save_queue(q, [slot_key])
+        if not current_busy:
+            issued, busy_seconds = _issue_now(cardinal, owner_uid, acc, buyer_id, chat_id, cmd)
+            if issued:
+                return True
+        if not account_queue_enabled:
+            _send_to_buyer(cardinal, chat_id, f'❌ Код уже занят другим покупателем. Попробуйте через {_format_time_left(busy_seconds)}.', owner_uid, {'ts': int(time.time()), 'type': 'BUSY', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'nick': buyer_nick, 'msg': f'очередь аккаунта или общая очередь выключена, ждать {busy_seconds}s'})
             return
-        ids_changed = False
-        for owner_uid, accounts in (data or {}).items():
-            if owner_uid == 'global' or not isinstance(accounts, list):
-                continue
-            if _ensure_account_ids(str(owner_uid), accounts):
-                ids_changed = True
-        if ids_changed:
-            save_data(data)
-        for owner_uid, accounts in (data or {}).items():
-            if owner_uid == 'global' or not isinstance(accounts, list):
-                continue
-            for acc in accounts:
-                cmd_raw = str(acc.get('command', '') or '')
-                cmd = _normalize_cmd(cmd_raw)
-                if not cmd or text != cmd:
-                    continue
-                _log_event(str(owner_uid), 'COMMAND', 'Команда распознана', name=str(acc.get('name') or ''), cmd=cmd, buyer=str(buyer_id), nick=str(buyer_nick))
-                account_enabled = bool(acc.get('enabled', True))
-                account_queue_enabled = bool(cfg.get('queue_enabled', True)) and bool(acc.get('queue_enabled', True))
-                if not _account_command_notifications_effective(acc, cfg):
-                    _notify_debug('exact_sda_command_matched', chat_id=str(chat_id), buyer_id=str(buyer_id), buyer_nick=str(buyer_nick), cmd=str(cmd), raw_text=str(raw_text), account_name=str(acc.get('name') or ''))
-                    _mark_recent_command_notification_suppression(chat_id=chat_id, buyer_id=buyer_id, cmd=cmd, raw_text=raw_text)
-                if not account_enabled:
-                    cardinal.account.send_message(chat_id, '❌ Выдача кодов для этого аккаунта временно отключена.')
-                    _push_log(owner_uid, {'ts': int(time.time()), 'type': 'DISABLED', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'nick': buyer_nick, 'msg': 'выдача кодов аккаунта выключена'})
-                    return True
-                if _try_blacklist_reject(cardinal, str(owner_uid), acc, buyer_id, buyer_nick, chat_id, cmd, cfg):
-                    return True
-                account_key = _account_key(owner_uid, acc)
-                with _queue_lock:
-                    q = load_queue()
-                    _cleanup_queue_state(q)
-                    st = _ensure_queue_state(q, account_key)
-                    now = int(time.time())
-                    current_window = _current_window()
-                    active_until = int(st.get('active_until') or 0)
-                    current_busy = st.get('active_buyer') and int(st.get('last_window') or -1) == current_window and (active_until > now)
-                    busy_seconds = max(1, active_until - now)
-                    save_queue(q)
-                if current_busy:
-                    if not account_queue_enabled:
-                        cardinal.account.send_message(chat_id, f'❌ Код уже занят другим покупателем. Попробуйте через {_format_time_left(busy_seconds)}.')
-                        _push_log(owner_uid, {'ts': int(time.time()), 'type': 'BUSY', 'name': str(acc.get('name') or ''), 'cmd': cmd, 'buyer': buyer_id, 'nick': buyer_nick, 'msg': f'очередь аккаунта или общая очередь выключена, ждать {busy_seconds}s'})
-                        return
-                    return _enqueue_buyer(cardinal, account_key, owner_uid, acc, buyer_id, chat_id, cmd)
-                return _issue_now(cardinal, owner_uid, acc, buyer_id, chat_id, cmd)
+        return _enqueue_buyer(cardinal, slot_key, owner_uid, acc, buyer_id, chat_id, cmd)
     except Exception as e:
         logger.exception(f'{PREFIX} new_message_handler error: {e}')
         _log_error_for_all_owners('new_message_handler', e)
@@ -3868,7 +5513,7 @@ def _server_meta_watch_worker(cardinal):
             continue
         if result is False:
             return
-        time.sleep(max(60, int(os.getenv('SDA_AUTHOR_META_CHECK_INTERVAL_SEC', '300'))))
+        time.sleep(_env_int('SDA_AUTHOR_META_CHECK_INTERVAL_SEC', 300, 60))
 
 def _start_server_meta_watch(cardinal):
     global _SERVER_META_WATCH_STARTED
@@ -3879,7 +5524,7 @@ def _start_server_meta_watch(cardinal):
     threading.Thread(target=_server_meta_watch_worker, args=(cardinal,), name='SDA-META-SYNC', daemon=True).start()
 
 def _tamper_restart_options():
-    return max(10, int(os.getenv('SDA_TAMPER_RESTART_INTERVAL_SEC', '3600'))), max(1, int(os.getenv('SDA_TAMPER_MAX_RESTARTS', '1000')))
+    return _env_int('SDA_TAMPER_RESTART_INTERVAL_SEC', 3600, 10), _env_int('SDA_TAMPER_MAX_RESTARTS', 1000, 1)
 
 def _get_tamper_restart_interval(base_interval_sec, attempt):
     return max(10, int(base_interval_sec / (2 ** (max(1, int(attempt)) - 1))))
@@ -3966,14 +5611,16 @@ def init_cardinal(cardinal: 'Cardinal'):
     else:
         _start_tamper_restart_cycle(cardinal, False)
     _start_server_meta_watch(cardinal)
+    _migrate_data_file()
+    _start_usage_sweeper()
+    _start_steam_time_sync()
+    _start_outbox_retry(cardinal)
+    _start_queue_tick(cardinal)
     _patch_new_message_notifications(cardinal)
     tg = cardinal.telegram
     try:
-        startup_data = load_data()
-        for owner_uid, accounts in (startup_data or {}).items():
-            if owner_uid == 'global' or not isinstance(accounts, list):
-                continue
-            _log_event(str(owner_uid), 'START', f'Плагин запущен. Версия {VERSION}', accounts=len(accounts))
+        for owner_uid, accounts in list(_iter_owner_accounts()):
+            _log_event(owner_uid, 'START', f'Плагин запущен. Версия {VERSION}', accounts=len(accounts))
         logger.info(f'{PREFIX} plugin started, version={VERSION}')
     except Exception as e:
         logger.warning(f'{PREFIX} startup log failed: {e}')
@@ -4002,6 +5649,7 @@ def init_cardinal(cardinal: 'Cardinal'):
     tg.cbq_handler(lambda c: start_account_custom_text_edit(cardinal, c), func=lambda c: c.data.startswith(f'{CB_ACCOUNT_TEXT_CUSTOM}:'))
     tg.cbq_handler(lambda c: start_account_secret_edit(cardinal, c), func=lambda c: c.data.startswith(f'{CB_ACCOUNT_EDIT_SECRET}:'))
     tg.cbq_handler(lambda c: start_account_limit_edit(cardinal, c), func=lambda c: c.data.startswith(f'{CB_ACCOUNT_EDIT_LIMIT}:'))
+    tg.cbq_handler(lambda c: start_account_slots_edit(cardinal, c), func=lambda c: c.data.startswith(f'{CB_ACCOUNT_EDIT_SLOTS}:'))
     tg.cbq_handler(lambda c: open_del_menu(cardinal, c), func=lambda c: c.data == CB_DEL_MENU)
     tg.cbq_handler(lambda c: start_template_edit(cardinal, c), func=lambda c: c.data == CB_TEMPLATE)
     tg.cbq_handler(lambda c: open_config_menu(cardinal, c), func=lambda c: c.data == CB_CONFIG_MENU)
@@ -4043,16 +5691,15 @@ def init_cardinal(cardinal: 'Cardinal'):
     except Exception as e:
         logger.warning(f'{PREFIX} add_telegram_commands failed: {e}')
     try:
-        q = load_queue()
-        _cleanup_queue_state(q)
-        save_queue(q)
+        with _queue_stripes:
+            q = load_queue()
+            _cleanup_queue_state(q)
+            save_queue(q)
+            pending = [slot_key for slot_key, st in q.items() if isinstance(st, dict) and st.get('queue')]
         if _plugin_enabled() and _queue_enabled():
-            for account_key, st in q.items():
-                if not isinstance(st, dict) or not st.get('queue'):
-                    continue
-                _, acc, cfg = _find_live_account_by_key(account_key)
-                if acc is not None and _account_queue_effective(acc, cfg):
-                    _schedule_queue_processing(cardinal, account_key, _seconds_to_next_slot())
+            for slot_key in pending:
+                if _slot_queue_effective(slot_key):
+                    _schedule_queue_processing(cardinal, slot_key, _seconds_to_next_slot())
     except Exception as e:
         logger.warning(f'{PREFIX} queue init failed: {e}')
 BIND_TO_PRE_INIT = [init_cardinal]